@@ -0,0 +1,99 @@
+""" time and storage allocations per decoder step, for the Decoder block
+(imperative and hybridized) and the IncrementalDecoder, at the sizes of the
+training scripts
+
+python bench_decoder.py --batch_sizes 1,32 --vocab 20000
+"""
+import argparse
+import re
+import time
+
+from mxnet import init, nd, profiler
+
+from device import add_device_arguments, select_contexts
+from inference import encode
+from model import (Decoder, DecoderInitState, Encoder, IncrementalDecoder,
+                   hybridize_models)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_sizes", help="comma separated batch sizes", type=str, default='1,32')
+parser.add_argument("--vocab", help="input and output vocabulary size", type=int, default=20000)
+parser.add_argument("--steps", help="decoding steps per sequence", type=int, default=20)
+parser.add_argument("--repeats", help="timed sequences per setting", type=int, default=5)
+add_device_arguments(parser)
+args = parser.parse_args()
+
+max_seq_len = 15
+encoder_num_layers = 3
+decoder_num_layers = 4
+encoder_num_hiddens = 256
+decoder_num_hiddens = 256
+alignment_size = 25
+ctx = select_contexts(args.device, args.cpu_threads)[0]
+
+
+def build():
+    encoder = Encoder(args.vocab, encoder_num_hiddens, encoder_num_layers, 0.)
+    decoder = Decoder(decoder_num_hiddens, args.vocab, decoder_num_layers,
+                      max_seq_len, 0., alignment_size, encoder_num_hiddens)
+    decoder_init_state = DecoderInitState(encoder_num_hiddens,
+                                          decoder_num_hiddens)
+    for block in (encoder, decoder, decoder_init_state):
+        block.initialize(init.Xavier(), ctx=ctx)
+    return encoder, decoder, decoder_init_state
+
+
+def block_loop(decoder, context, inputs):
+    encoder_outputs = context.encoder_outputs.flatten()
+    state = context.decoder_state
+    for _ in range(args.steps):
+        output, state = decoder(inputs, state, encoder_outputs,
+                                context.encoder_keys)
+        inputs = output.argmax(axis=1)
+    return inputs
+
+
+def incremental_loop(decoder, context, inputs):
+    stepper = IncrementalDecoder(decoder).begin(
+        context.encoder_outputs, context.encoder_keys, context.decoder_state,
+        ctx)
+    for _ in range(args.steps):
+        inputs = stepper.step(inputs).argmax(axis=1)
+    return inputs
+
+
+def measure(loop, decoder, context, inputs):
+    """ ms and storage allocations per step"""
+    loop(decoder, context, inputs).wait_to_read()
+    tic = time.perf_counter()
+    for _ in range(args.repeats):
+        loop(decoder, context, inputs).wait_to_read()
+    ms = (time.perf_counter() - tic) * 1000 / (args.repeats * args.steps)
+    profiler.set_config(profile_memory=True, profile_imperative=True,
+                        aggregate_stats=True)
+    profiler.set_state('run')
+    loop(decoder, context, inputs).wait_to_read()
+    profiler.set_state('stop')
+    # one count per allocation and per release of device storage
+    counts = re.findall(r'Memory: \S+\s+(\d+)', profiler.dumps(reset=True))
+    return ms, sum(int(c) for c in counts) / 2. / args.steps
+
+
+encoder, decoder, decoder_init_state = build()
+print('batch  decoder        ms/step  allocations/step')
+for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+    questions = nd.random.randint(4, args.vocab, (batch_size, max_seq_len),
+                                  ctx=ctx).astype('float32')
+    context = encode(encoder, decoder, decoder_init_state, questions, ctx)
+    inputs = nd.full((batch_size,), 2, ctx=ctx)
+    results = [('block', measure(block_loop, decoder, context, inputs))]
+    hybridize_models(decoder)
+    results.append(('hybridized', measure(block_loop, decoder, context,
+                                          inputs)))
+    # the next batch size measures the imperative block again
+    decoder.hybridize(active=False)
+    results.append(('incremental', measure(incremental_loop, decoder,
+                                           context, inputs)))
+    for name, (ms, allocations) in results:
+        print('%5d  %-12s  %7.2f  %16.1f' % (batch_size, name, ms,
+                                             allocations))
@@ -1,10 +1,11 @@
 import sys
 sys.path.append('..')
 import collections
-import mxnet as mx
 from mxnet import autograd, gluon, init, metric, nd
 from mxnet.gluon import loss as gloss, nn, rnn
 from mxnet.contrib import text
+from corpus import make_vocab
+from device import select_contexts
 import os
 import random
 import zipfile
@@ -63,8 +64,10 @@ def count_token(train_tokenized):
                 token_counter[token] += 1
 
 count_token(train_tokenized)
-vocab = text.vocab.Vocabulary(token_counter, unknown_token='<unk>',
-                              reserved_tokens=None)
+# rare tokens map to <unk>, which also keeps the glove matrix small
+min_freq = 1
+max_vocab = None
+vocab = make_vocab(token_counter, min_freq, max_vocab, reserved_tokens=None)
 
 def encode_samples(tokenized_samples, vocab):
     features = []
@@ -91,7 +94,8 @@ def pad_samples(features, maxlen=500, padding=0):
         padded_features.append(padded_feature)
     return padded_features
 
-ctx = mx.gpu()
+# $CHATBOT_DEVICE, or the gpu when there is one
+ctx = select_contexts()[0]
 train_features = encode_samples(train_tokenized, vocab)
 test_features = encode_samples(test_tokenized, vocab)
 train_features = nd.array(pad_samples(train_features, 500, 0), ctx=ctx)
@@ -0,0 +1,176 @@
+import json
+import os
+import pickle
+import queue
+import threading
+
+import mxnet as mx
+from mxnet import nd
+
+
+def copy_states(state):
+    """ cpu copy of an optimizer state, NDArray or (nested) tuple of them"""
+    if isinstance(state, nd.NDArray):
+        return state.copyto(mx.cpu())
+    if isinstance(state, (tuple, list)):
+        return type(state)(copy_states(s) for s in state)
+    return state
+
+
+def atomic_write(filename, write):
+    """ write(tmp) and rename the complete file into place"""
+    tmp = filename + '.tmp'
+    write(tmp)
+    os.replace(tmp, filename)
+
+
+def read_index(prefix):
+    """ the checkpoint list of <prefix>-checkpoints.json, empty if missing"""
+    index_file = prefix + '-checkpoints.json'
+    if not os.path.exists(index_file):
+        return {'checkpoints': [], 'best': None}
+    with open(index_file) as f:
+        return json.load(f)
+
+
+def save_model_info(prefix, input_vocab, output_vocab, config):
+    """ write what a server needs besides the params to <prefix>-model.pkl
+
+    config holds the sizes the blocks are built with, see serving.py.
+    """
+    def write(tmp):
+        with open(tmp, 'wb') as f:
+            pickle.dump((input_vocab, output_vocab, config), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+    atomic_write(prefix + '-model.pkl', write)
+
+
+def load_model_info(prefix):
+    """ (input_vocab, output_vocab, config) saved by save_model_info"""
+    with open(prefix + '-model.pkl', 'rb') as f:
+        return pickle.load(f)
+
+
+class CheckpointManager(object):
+    """ versioned checkpoints written by a background thread
+
+    every save writes <prefix>-<epoch>.params and the trainer states to
+    <prefix>-<epoch>.states, then <prefix>-checkpoints.json which lists
+    them. the last `keep` checkpoints and the one with the lowest loss are
+    kept, older ones are removed. without resume the checkpoints of an
+    earlier run under prefix are dropped, they are removed once the first
+    checkpoint of this run is written.
+    """
+    def __init__(self, prefix, keep=3, resume=True):
+        self.prefix = prefix
+        self.keep = keep
+        self.index_file = prefix + '-checkpoints.json'
+        self.index = read_index(prefix)
+        self._stale = []
+        if not resume:
+            self._stale = self.index['checkpoints']
+            self.index = {'checkpoints': [], 'best': None}
+        # one snapshot in flight at most, the next save waits for its write
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def filename(self, epoch, ext):
+        return '%s-%04d.%s' % (self.prefix, epoch, ext)
+
+    def save(self, epoch, model, trainer, loss):
+        """ snapshot the params and trainer states, write them later
+
+        the copies are queued on the engine before the next update, so the
+        training loop only waits when the previous write is not done yet.
+        """
+        self._raise()
+        # structural names, as written by save_parameters(deduplicate=True):
+        # a shared param is stored under one of its names only
+        names = {param: name for name, param
+                 in model._collect_params_with_prefix().items()}
+        params = {name: copy_states(param.data(param.list_ctx()[0]))
+                  for param, name in names.items()}
+        updater = trainer._updaters[0]
+        states = {i: copy_states(state)
+                  for i, state in updater.states.items()}
+        # the update counts go on changing, pickle them now
+        optimizer = pickle.dumps(updater.optimizer)
+        if isinstance(loss, nd.NDArray):
+            # read back by the writer, the training loop does not wait
+            loss = loss.copyto(mx.cpu())
+        self._queue.put((epoch, params, states, optimizer, loss))
+
+    def wait(self):
+        """ block until every queued checkpoint is on disk"""
+        self._queue.join()
+        self._raise()
+
+    def latest(self):
+        checkpoints = self.index['checkpoints']
+        return checkpoints[-1]['epoch'] if checkpoints else None
+
+    def restore(self, model, trainer, ctx=None, epoch=None):
+        """ load params and trainer states, the latest epoch by default
+
+        returns the restored epoch, or None when there is no checkpoint.
+        """
+        epoch = self.latest() if epoch is None else epoch
+        if epoch is None:
+            return None
+        model.load_parameters(self.filename(epoch, 'params'), ctx=ctx)
+        trainer.load_states(self.filename(epoch, 'states'))
+        return epoch
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, epoch, params, states, optimizer, loss):
+        if isinstance(loss, nd.NDArray):
+            loss = loss.asscalar()
+        loss = float(loss)
+        atomic_write(self.filename(epoch, 'params'),
+                     lambda tmp: nd.save(tmp, params))
+        states = pickle.dumps((states, pickle.loads(optimizer)))
+
+        def write_states(tmp):
+            with open(tmp, 'wb') as f:
+                f.write(states)
+        atomic_write(self.filename(epoch, 'states'), write_states)
+
+        checkpoints = [c for c in self.index['checkpoints']
+                       if c['epoch'] != epoch] + [{'epoch': epoch,
+                                                   'loss': loss}]
+        best = min(checkpoints, key=lambda c: c['loss'])
+        kept = checkpoints[max(len(checkpoints) - self.keep, 0):]
+        if best not in kept:
+            kept.insert(0, best)
+        index = {'checkpoints': kept, 'best': best['epoch']}
+
+        def write_index(tmp):
+            with open(tmp, 'w') as f:
+                json.dump(index, f)
+        # the index is replaced last, it only lists complete files
+        atomic_write(self.index_file, write_index)
+        self.index = index
+        kept_epochs = set(c['epoch'] for c in kept)
+        removed = [c for c in checkpoints + self._stale
+                   if c['epoch'] not in kept_epochs]
+        self._stale = []
+        for c in removed:
+            for ext in ('params', 'states'):
+                if os.path.exists(self.filename(c['epoch'], ext)):
+                    os.remove(self.filename(c['epoch'], ext))
@@ -0,0 +1,430 @@
+import collections
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+from array import array
+from itertools import chain, islice
+
+import numpy as np
+from mxnet import nd
+from mxnet.contrib import text
+from mxnet.gluon import data as gdata
+
+PAD = '<pad>'
+BOS = '<bos>'
+EOS = '<eos>'
+# bump when the layout of the corpus cache changes
+CACHE_VERSION = 1
+
+
+def read_pairs(dataset, max_seq_len, sep='@', encoding=None, max_lines=None):
+    """ stream the (input_tokens, output_tokens) pairs of a corpus file
+
+    the file is read one `question<sep>answer` line at a time, pairs with a
+    side longer than max_seq_len - 1 tokens (eos has to fit) are skipped.
+    """
+    with open(dataset, 'r', encoding=encoding) as f:
+        for line in islice(f, max_lines):
+            line = line.rstrip()
+            if not line:
+                continue
+            input_seq, output_seq = line.split(sep)
+            input_tokens = input_seq.split(' ')
+            output_tokens = output_seq.split(' ')
+            if len(input_tokens) < max_seq_len and \
+                    len(output_tokens) < max_seq_len:
+                yield input_tokens, output_tokens
+
+
+def make_vocab(counter, min_freq=1, max_size=None,
+               reserved_tokens=(PAD, BOS, EOS)):
+    """ vocabulary of the tokens seen at least min_freq times
+
+    max_size caps the number of rows, <unk> and the reserved tokens
+    included, by keeping the most frequent tokens. every token left out maps
+    to <unk> (index 0).
+    """
+    reserved_tokens = list(reserved_tokens) if reserved_tokens else None
+    most_freq_count = None
+    if max_size is not None:
+        most_freq_count = max(max_size - 1 - len(reserved_tokens or []), 0)
+    return text.vocab.Vocabulary(counter, most_freq_count=most_freq_count,
+                                 min_freq=min_freq,
+                                 reserved_tokens=reserved_tokens)
+
+
+def build_vocabs(pairs, min_freq=1, max_size=None, joint=False):
+    """ count the tokens of streamed pairs into input and output vocabs
+
+    joint counts both sides into one vocabulary, returned for both.
+    """
+    input_counter = collections.Counter()
+    output_counter = input_counter if joint else collections.Counter()
+    for input_tokens, output_tokens in pairs:
+        input_counter.update(input_tokens)
+        output_counter.update(output_tokens)
+    if joint:
+        vocab = make_vocab(input_counter, min_freq, max_size)
+        return vocab, vocab
+    return (make_vocab(input_counter, min_freq, max_size),
+            make_vocab(output_counter, min_freq, max_size))
+
+
+def coverage_table(counter, sizes):
+    """ (size, min count, coverage) rows for vocabularies of the given sizes
+
+    size counts the counted tokens only, coverage is the fraction of the
+    token occurrences that such a vocabulary keeps, the rest become <unk>.
+    """
+    counts = np.sort(np.fromiter(counter.values(), dtype=np.int64,
+                                 count=len(counter)))[::-1]
+    covered = np.cumsum(counts)
+    rows = []
+    for size in sizes:
+        size = min(size, len(counts))
+        if size > 0:
+            rows.append((size, int(counts[size - 1]),
+                         covered[size - 1] / float(covered[-1])))
+    return rows
+
+
+def coverage(counts, vocab):
+    """ fraction of the indexed tokens that are not <unk>
+
+    counts are the per index counts of token_counts, the reserved tokens
+    (eos is appended to every sequence) do not take part.
+    """
+    reserved = [vocab.token_to_idx[token] for token in vocab.reserved_tokens]
+    total = counts.sum() - counts[reserved].sum()
+    return 1. - counts[vocab.token_to_idx[vocab.unknown_token]] / \
+        float(max(total, 1))
+
+
+class TokenCounter(object):
+    """ count tokens and give them provisional ids in order of appearance
+
+    lets a single pass count the vocabulary and index the corpus, the
+    provisional ids are remapped once the vocabulary is known.
+    """
+    def __init__(self):
+        self.token_to_id = {}
+        self.counts = []
+
+    def to_indices(self, tokens):
+        indices = []
+        for token in tokens:
+            idx = self.token_to_id.setdefault(token, len(self.counts))
+            if idx == len(self.counts):
+                self.counts.append(0)
+            self.counts[idx] += 1
+            indices.append(idx)
+        return indices
+
+    def vocab(self, min_freq=1, max_size=None):
+        """ return the vocabulary and the provisional id -> index table
+
+        tokens cut from the vocabulary are remapped to <unk>.
+        """
+        vocab = make_vocab(
+            collections.Counter(dict(zip(self.token_to_id, self.counts))),
+            min_freq, max_size)
+        remap = np.array(vocab.to_indices(list(self.token_to_id)),
+                         dtype=np.int32)
+        return vocab, remap
+
+
+def pairs2flat(pairs, input_to_indices, output_to_indices):
+    """ concatenate the indices of streamed pairs, with their lengths"""
+    input_flat, output_flat = array('i'), array('i')
+    input_lengths, output_lengths = array('i'), array('i')
+    for input_tokens, output_tokens in pairs:
+        input_flat.extend(input_to_indices(input_tokens))
+        input_lengths.append(len(input_tokens))
+        output_flat.extend(output_to_indices(output_tokens))
+        output_lengths.append(len(output_tokens))
+    return input_flat, input_lengths, output_flat, output_lengths
+
+
+def flat2indices(flat, lengths, vocab, max_seq_len):
+    """ lay concatenated index rows out as a padded matrix, eos after each"""
+    lengths = np.asarray(lengths, dtype=np.int32)
+    indices = np.full((len(lengths), max_seq_len), vocab.token_to_idx[PAD],
+                      dtype=np.int32)
+    indices[np.arange(max_seq_len) < lengths[:, None]] = \
+        np.asarray(flat, dtype=np.int32)
+    indices[np.arange(len(lengths)), lengths] = vocab.token_to_idx[EOS]
+    return indices
+
+
+def pairs2indices(pairs, input_vocab, output_vocab, max_seq_len):
+    """ convert streamed pairs into two (num_pairs, max_seq_len) matrices
+
+    only the int32 indices are kept while streaming, the padded string
+    sequences are never built.
+    """
+    input_flat, input_lengths, output_flat, output_lengths = pairs2flat(
+        pairs, input_vocab.to_indices, output_vocab.to_indices)
+    return (flat2indices(input_flat, input_lengths, input_vocab, max_seq_len),
+            flat2indices(output_flat, output_lengths, output_vocab,
+                         max_seq_len))
+
+
+def keep_qa_pairs(pairs, qa_pairs, max_pairs=None):
+    """ pass streamed pairs through, collecting the [question, answer] of
+    the first max_pairs (all when None)"""
+    for input_tokens, output_tokens in pairs:
+        if max_pairs is None or len(qa_pairs) < max_pairs:
+            qa_pairs.append([' '.join(input_tokens), ' '.join(output_tokens)])
+        yield input_tokens, output_tokens
+
+
+def load_corpus(dataset, max_seq_len, vocab_dataset=None, sep='@',
+                encoding=None, max_lines=None, keep_pairs=False,
+                cache_dir=None, mmap_mode=None, min_freq=1, max_vocab=None,
+                joint_vocab=False):
+    """ parse a corpus file once into vocabs and index matrices
+
+    returns (input_vocab, output_vocab, input_indices, output_indices,
+    qa_pairs). qa_pairs[i] is the raw [question, answer] of index row i, for
+    every row with keep_pairs=True, the first keep_pairs rows with a number
+    and None without keep_pairs. the vocabs are counted from vocab_dataset
+    when given, pruned by min_freq and max_vocab (see make_vocab) and one
+    shared vocab with joint_vocab. with cache_dir the result is cached on
+    disk, mmap_mode then maps the cached index matrices instead of reading
+    them.
+    """
+    if mmap_mode is not None and cache_dir is None:
+        raise ValueError('mmap_mode needs a cache_dir to map the index '
+                         'matrices from')
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, corpus_cache_key(
+            dataset, max_seq_len, vocab_dataset, sep, encoding, max_lines,
+            keep_pairs, min_freq, max_vocab, joint_vocab))
+        if not os.path.isdir(path):
+            save_corpus_cache(path, *load_corpus(
+                dataset, max_seq_len, vocab_dataset, sep, encoding,
+                max_lines, keep_pairs, min_freq=min_freq,
+                max_vocab=max_vocab, joint_vocab=joint_vocab))
+        return load_corpus_cache(path, mmap_mode)
+
+    pairs = read_pairs(dataset, max_seq_len, sep, encoding, max_lines)
+    qa_pairs = None
+    if keep_pairs:
+        qa_pairs = []
+        pairs = keep_qa_pairs(
+            pairs, qa_pairs, None if keep_pairs is True else keep_pairs)
+    if vocab_dataset is not None and vocab_dataset != dataset:
+        input_vocab, output_vocab = build_vocabs(
+            read_pairs(vocab_dataset, max_seq_len, sep, encoding),
+            min_freq, max_vocab, joint_vocab)
+        input_indices, output_indices = pairs2indices(
+            pairs, input_vocab, output_vocab, max_seq_len)
+        return (input_vocab, output_vocab, input_indices, output_indices,
+                qa_pairs)
+
+    input_counter = TokenCounter()
+    output_counter = input_counter if joint_vocab else TokenCounter()
+    input_flat, input_lengths, output_flat, output_lengths = pairs2flat(
+        pairs, input_counter.to_indices, output_counter.to_indices)
+    input_vocab, input_remap = input_counter.vocab(min_freq, max_vocab)
+    output_vocab, output_remap = (input_vocab, input_remap) if joint_vocab \
+        else output_counter.vocab(min_freq, max_vocab)
+    input_indices = flat2indices(
+        input_remap[np.asarray(input_flat, dtype=np.int32)], input_lengths,
+        input_vocab, max_seq_len)
+    output_indices = flat2indices(
+        output_remap[np.asarray(output_flat, dtype=np.int32)],
+        output_lengths, output_vocab, max_seq_len)
+    return input_vocab, output_vocab, input_indices, output_indices, qa_pairs
+
+
+def seqs2indices(seqs, vocab, max_seq_len):
+    """ map token lists to one (len(seqs), max_seq_len) int32 index matrix
+
+    all tokens go through the vocabulary in a single call, rows shorter
+    than max_seq_len are filled with the pad index.
+    """
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    flat = np.asarray(vocab.to_indices(list(chain.from_iterable(seqs))),
+                      dtype=np.int32)
+    indices = np.full((len(seqs), max_seq_len), vocab.token_to_idx[PAD],
+                      dtype=np.int32)
+    indices[np.arange(max_seq_len) < lengths[:, None]] = flat
+    return indices
+
+
+class IndexDataset(gdata.Dataset):
+    """ (question, answer) index rows read lazily from host arrays
+
+    with memory-mapped arrays only the rows of the current batch are read
+    from disk, nothing is copied to the device up front and train() moves
+    each batch to ctx itself.
+    """
+    def __init__(self, input_indices, output_indices):
+        assert len(input_indices) == len(output_indices)
+        self.input_indices = input_indices
+        self.output_indices = output_indices
+
+    def __getitem__(self, idx):
+        return (self.input_indices[idx].astype(np.float32),
+                self.output_indices[idx].astype(np.float32))
+
+    def __len__(self):
+        return len(self.input_indices)
+
+
+def seq_lengths(indices, vocab, chunk_size=1 << 16):
+    """ number of non pad indices of each row, read chunk by chunk"""
+    pad_id = vocab.token_to_idx[PAD]
+    return np.concatenate([
+        (indices[start:start + chunk_size] != pad_id).sum(axis=1)
+        for start in range(0, len(indices), chunk_size)])
+
+
+def token_counts(indices, vocab, chunk_size=1 << 16):
+    """ occurrences of every index of vocab, pads left out"""
+    counts = np.zeros(len(vocab), dtype=np.int64)
+    for start in range(0, len(indices), chunk_size):
+        counts += np.bincount(
+            indices[start:start + chunk_size].ravel(), minlength=len(vocab))
+    counts[vocab.token_to_idx[PAD]] = 0
+    return counts
+
+
+class BucketSampler(gdata.Sampler):
+    """ batches of pairs with similar lengths
+
+    pairs are split into num_buckets buckets at the length quantiles, every
+    batch is drawn from a single bucket and the batch order is shuffled with
+    rng (a numpy RandomState, the global one when None).
+    """
+    def __init__(self, lengths, batch_size, num_buckets=10, shuffle=True,
+                 rng=None):
+        lengths = np.asarray(lengths)
+        boundaries = np.unique(np.percentile(
+            lengths, np.linspace(0, 100, num_buckets + 1)[1:]))
+        bucket_ids = np.searchsorted(boundaries, lengths)
+        self._buckets = [np.where(bucket_ids == b)[0]
+                         for b in range(len(boundaries))]
+        self._buckets = [bucket for bucket in self._buckets if len(bucket)]
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+        self._rng = np.random if rng is None else rng
+
+    def __iter__(self):
+        batches = []
+        for bucket in self._buckets:
+            if self._shuffle:
+                bucket = self._rng.permutation(bucket)
+            batches.extend(bucket[start:start + self._batch_size]
+                           for start in range(0, len(bucket),
+                                              self._batch_size))
+        if self._shuffle:
+            self._rng.shuffle(batches)
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return sum((len(bucket) + self._batch_size - 1) // self._batch_size
+                   for bucket in self._buckets)
+
+
+def trim_batchify(input_pad_id, output_pad_id):
+    """ stack a batch and cut the columns which are pad in every row"""
+    def trim(indices, pad_id):
+        return indices[:, :int((indices != pad_id).sum(axis=1).max())]
+
+    def batchify(samples):
+        x = np.stack([sample[0] for sample in samples])
+        y = np.stack([sample[1] for sample in samples])
+        return (nd.array(trim(x, input_pad_id)),
+                nd.array(trim(y, output_pad_id)))
+    return batchify
+
+
+class RandomSampler(gdata.Sampler):
+    """ gdata.RandomSampler drawing the order from rng (a numpy RandomState)
+    instead of the global generator"""
+    def __init__(self, length, rng):
+        self._length = length
+        self._rng = rng
+
+    def __iter__(self):
+        return iter(self._rng.permutation(self._length).tolist())
+
+    def __len__(self):
+        return self._length
+
+
+def bucket_loader(dataset, input_vocab, output_vocab, batch_size,
+                  num_buckets=10, rng=None):
+    """ DataLoader over an IndexDataset padding each batch to its bucket"""
+    lengths = np.maximum(
+        seq_lengths(dataset.input_indices, input_vocab),
+        seq_lengths(dataset.output_indices, output_vocab))
+    return gdata.DataLoader(
+        dataset, batch_sampler=BucketSampler(lengths, batch_size,
+                                             num_buckets, rng=rng),
+        batchify_fn=trim_batchify(input_vocab.token_to_idx[PAD],
+                                  output_vocab.token_to_idx[PAD]))
+
+
+def tensorize(input_indices, output_indices, ctx):
+    """ build the training dataset with one host to device copy per side"""
+    Q = nd.array(input_indices, ctx=ctx, dtype='float32')
+    A = nd.array(output_indices, ctx=ctx, dtype='float32')
+    return gdata.ArrayDataset(Q, A)
+
+
+def file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def corpus_cache_key(dataset, max_seq_len, vocab_dataset, sep, encoding,
+                     max_lines, keep_pairs, min_freq=1, max_vocab=None,
+                     joint_vocab=False):
+    """ name the cache entry after file contents and parse settings"""
+    sha1 = hashlib.sha1(file_hash(dataset).encode())
+    if vocab_dataset is not None and vocab_dataset != dataset:
+        sha1.update(file_hash(vocab_dataset).encode())
+    sha1.update(repr((CACHE_VERSION, max_seq_len, PAD, BOS, EOS, sep,
+                      encoding, max_lines, keep_pairs, min_freq,
+                      max_vocab, joint_vocab)).encode())
+    return sha1.hexdigest()
+
+
+def save_corpus_cache(path, input_vocab, output_vocab, input_indices,
+                      output_indices, qa_pairs):
+    """ write a cache entry, renamed into place once it is complete"""
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmp = tempfile.mkdtemp(dir=parent)
+    try:
+        np.save(os.path.join(tmp, 'input_indices.npy'), input_indices)
+        np.save(os.path.join(tmp, 'output_indices.npy'), output_indices)
+        with open(os.path.join(tmp, 'vocab.pkl'), 'wb') as f:
+            pickle.dump((input_vocab, output_vocab, qa_pairs), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+    except OSError:
+        # another process stored the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+
+
+def load_corpus_cache(path, mmap_mode=None):
+    with open(os.path.join(path, 'vocab.pkl'), 'rb') as f:
+        input_vocab, output_vocab, qa_pairs = pickle.load(f)
+    input_indices = np.load(os.path.join(path, 'input_indices.npy'),
+                            mmap_mode=mmap_mode)
+    output_indices = np.load(os.path.join(path, 'output_indices.npy'),
+                             mmap_mode=mmap_mode)
+    return input_vocab, output_vocab, input_indices, output_indices, qa_pairs
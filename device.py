@@ -0,0 +1,109 @@
+""" device selection and cpu runtime settings shared by the entry points
+
+the device comes from the --device flag, else from $CHATBOT_DEVICE, else it
+is auto: the first gpu when there is one, the cpu otherwise. on the cpu the
+operator threads come from --cpu_threads, else $CHATBOT_CPU_THREADS, else
+$OMP_NUM_THREADS is left to mxnet, else they are the cores the process may
+run on (see available_cpus).
+"""
+import ctypes
+import os
+import re
+import warnings
+
+import mxnet as mx
+
+DEVICE_ENV = 'CHATBOT_DEVICE'
+THREADS_ENV = 'CHATBOT_CPU_THREADS'
+
+
+def add_device_arguments(parser):
+    parser.add_argument("--device", help="cpu, gpu, gpu:0,1 or auto, defaults to $CHATBOT_DEVICE or auto", type=str, default=None)
+    parser.add_argument("--cpu_threads", help="operator threads on the cpu, defaults to $CHATBOT_CPU_THREADS, else $OMP_NUM_THREADS, else the cores available to the process", type=int, default=None)
+
+
+def num_gpus():
+    try:
+        return mx.context.num_gpus()
+    except mx.base.MXNetError:
+        # cuda build on a host without a driver
+        return 0
+
+
+def parse_device(device):
+    """ contexts of a device string, the cpu when the gpus are missing"""
+    device = (device or 'auto').strip().lower()
+    if device == 'cpu':
+        return [mx.cpu()]
+    if device == 'auto':
+        return [mx.gpu(0)] if num_gpus() > 0 else [mx.cpu()]
+    match = re.match(r'gpu(?::(\d+(?:,\d+)*))?$', device)
+    if match:
+        ids = [int(i) for i in match.group(1).split(',')] \
+            if match.group(1) else [0]
+        if max(ids) >= num_gpus():
+            warnings.warn('%s is not available on this host, running on the '
+                          'cpu' % device)
+            return [mx.cpu()]
+        return [mx.gpu(i) for i in ids]
+    raise ValueError('unknown device %r, expected cpu, gpu, gpu:0,1 or auto'
+                     % device)
+
+
+def available_cpus():
+    """ cores this process may run on: its cpu affinity, capped by the cfs
+    quota of its cgroup (docker --cpus), which openmp does not see
+    """
+    cpus = len(os.sched_getaffinity(0)) \
+        if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                quota = f.read().strip()
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = f.read().strip()
+        except OSError:
+            return cpus
+    if quota in ('max', '-1'):
+        return cpus
+    return max(1, min(cpus, -(-int(quota) // int(period))))
+
+
+def env_threads():
+    """ $CHATBOT_CPU_THREADS, None when it is not set"""
+    value = os.environ.get(THREADS_ENV, '').strip()
+    if not value:
+        return None
+    if not re.match(r'\d+$', value):
+        raise ValueError('%s=%r is not a number of threads'
+                         % (THREADS_ENV, value))
+    return int(value)
+
+
+def set_cpu_threads(num_threads):
+    """ number of openmp threads an operator runs on, mkl-dnn included"""
+    mx.base.check_call(mx.base._LIB.MXSetNumOMPThreads(
+        ctypes.c_int(num_threads)))
+
+
+def select_contexts(device=None, cpu_threads=None):
+    """ contexts to run on, the flags win over the environment
+
+    on the cpu the operator thread count is applied as well, so that
+    several serving processes on one host do not oversubscribe the cores.
+    """
+    if device is None:
+        device = os.environ.get(DEVICE_ENV)
+    if cpu_threads is None:
+        cpu_threads = env_threads()
+    ctxs = parse_device(device)
+    if ctxs[0].device_type != 'cpu':
+        return ctxs
+    if cpu_threads:
+        set_cpu_threads(cpu_threads)
+    elif 'OMP_NUM_THREADS' not in os.environ:
+        set_cpu_threads(available_cpus())
+    return ctxs
@@ -0,0 +1,226 @@
+import numpy as np
+from mxnet import nd
+from mxnet.gluon import nn
+
+from corpus import BOS, EOS, seqs2indices
+from model import IncrementalDecoder
+# score of dead beams, finite so that adding log probs stays finite
+NEG_INF = -1e9
+
+
+def questions2indices(questions, input_vocab, max_seq_len):
+    """ pad (or cut) each question to max_seq_len and map it to indices"""
+    # keep one position for eos
+    return seqs2indices([question.split(' ')[:max_seq_len - 1] + [EOS]
+                         for question in questions], input_vocab, max_seq_len)
+
+
+def indices2tokens(indices, output_vocab):
+    """ cut each row of predicted indices at the first eos"""
+    eos_id = output_vocab.token_to_idx[EOS]
+    replies = []
+    for row in indices:
+        tokens = []
+        for idx in row:
+            if idx == eos_id:
+                break
+            tokens.append(output_vocab.idx_to_token[idx])
+        replies.append(tokens)
+    return replies
+
+
+def shortlist_decoder(decoder, size):
+    """ restrict the output layer of decoder to the size most frequent tokens
+
+    the output vocab is sorted by frequency after the reserved tokens, so
+    the shortlist is the first size rows of the projection. for inference
+    only, the decoder can not be trained or saved afterwards.
+    """
+    ctx = decoder.out.weight.list_ctx()
+    out = nn.Dense(size, in_units=decoder.hidden_size, flatten=False)
+    out.initialize(ctx=ctx)
+    out.weight.set_data(decoder.out.weight.data(ctx[0])[:size])
+    out.bias.set_data(decoder.out.bias.data(ctx[0])[:size])
+    # a new child drops the compiled graph of the decoder
+    decoder.out = out
+
+
+class EncodedContext(object):
+    """ what decoding needs from the encoder for a batch of questions
+
+    the encoder outputs (seq_len, batch, hidden), their attention keys and
+    the initial decoder state. decoding does not change them, so one
+    context serves any number of decode calls.
+    """
+    def __init__(self, encoder_outputs, encoder_keys, decoder_state):
+        self.encoder_outputs = encoder_outputs
+        self.encoder_keys = encoder_keys
+        self.decoder_state = decoder_state
+
+    @property
+    def batch_size(self):
+        return self.encoder_outputs.shape[1]
+
+
+def encode(encoder, decoder, decoder_init_state, inputs, ctx):
+    """ run the encoder side of a (batch, max_seq_len) index batch once"""
+    encoder_state = encoder.begin_state(func=nd.zeros,
+                                        batch_size=inputs.shape[0], ctx=ctx)
+    encoder_outputs, encoder_state = encoder(inputs, encoder_state)
+    return EncodedContext(encoder_outputs,
+                          decoder.attention_keys(encoder_outputs),
+                          decoder_init_state(encoder_state[0]))
+
+
+def greedy_decode(encoder, decoder, decoder_init_state, inputs, bos_id,
+                  eos_id, ctx, max_test_output_len, context=None,
+                  temperature=None):
+    """ greedy decode a (batch, max_seq_len) index batch, all rows at once
+
+    the predictions stay on ctx, the caller copies them back once. with a
+    context from encode() inputs are not used and the encoder is skipped.
+    a temperature samples every token from the softmax at that temperature
+    instead of taking the argmax, <unk> and the reserved tokens but eos are
+    never sampled.
+    """
+    if context is None:
+        context = encode(encoder, decoder, decoder_init_state, inputs, ctx)
+    cur_batch_size = context.batch_size
+    stepper = IncrementalDecoder(decoder).begin(
+        context.encoder_outputs, context.encoder_keys, context.decoder_state,
+        ctx)
+    decoder_input = nd.full((cur_batch_size,), bos_id, ctx=ctx)
+    # 1 for rows which already produced eos
+    finished = nd.zeros((cur_batch_size,), ctx=ctx)
+    preds = []
+    mask = None
+    for _ in range(max_test_output_len):
+        decoder_output = stepper.step(decoder_input)
+        if temperature:
+            if mask is None:
+                # the vocab starts with <unk>, pad, bos and eos (make_vocab)
+                mask = nd.array(np.where(
+                    np.arange(decoder_output.shape[1]) < eos_id, NEG_INF, 0.),
+                    ctx=ctx, dtype=decoder_output.dtype).reshape((1, -1))
+            pred = nd.random.multinomial(nd.softmax(nd.broadcast_add(
+                decoder_output / temperature, mask))).astype('float32')
+        else:
+            pred = decoder_output.argmax(axis=1)
+        # finished rows keep emitting eos
+        pred = finished * eos_id + (1 - finished) * pred
+        finished = nd.maximum(finished, pred == eos_id)
+        preds.append(pred)
+        decoder_input = pred
+    return nd.stack(*preds, axis=1)
+
+
+def length_normalize(score, length, length_penalty):
+    """ GNMT length penalty, length_penalty=0 keeps the raw log prob"""
+    return score / (((5. + length) / 6.) ** length_penalty)
+
+
+def beam_search_decode(encoder, decoder, decoder_init_state, inputs, bos_id,
+                       eos_id, ctx, max_test_output_len, beam_size,
+                       length_penalty=0.6, context=None):
+    """ beam search a (batch, max_seq_len) index batch, all beams at once
+
+    returns one list of predicted indices (without eos) per row. with a
+    context from encode() inputs are not used and the encoder is skipped.
+    """
+    if context is None:
+        context = encode(encoder, decoder, decoder_init_state, inputs, ctx)
+    cur_batch_size = context.batch_size
+    # beams of a row share its encoder outputs and attention keys, tile them
+    # once per batch instead of once per step
+    stepper = IncrementalDecoder(decoder).begin(
+        nd.repeat(context.encoder_outputs, repeats=beam_size, axis=1),
+        nd.repeat(context.encoder_keys, repeats=beam_size, axis=1),
+        [nd.repeat(s, repeats=beam_size, axis=1)
+         for s in context.decoder_state], ctx)
+    decoder_input = nd.full((cur_batch_size * beam_size,), bos_id, ctx=ctx)
+    row_offset = nd.arange(0, cur_batch_size * beam_size, beam_size,
+                           ctx=ctx).reshape((-1, 1))
+    # only the first beam is alive before the first step
+    np_scores = np.full((cur_batch_size, beam_size), NEG_INF,
+                        dtype=np.float32)
+    np_scores[:, 0] = 0
+    scores = nd.array(np_scores, ctx=ctx)
+    hyps = [[[] for _ in range(beam_size)] for _ in range(cur_batch_size)]
+    # (normalized score, indices) of the hypotheses which produced eos
+    finished = [[] for _ in range(cur_batch_size)]
+    done = [False] * cur_batch_size
+
+    for step in range(1, max_test_output_len + 1):
+        decoder_output = stepper.step(decoder_input)
+        vocab_size = decoder_output.shape[1]
+        log_probs = nd.log_softmax(decoder_output) + scores.reshape((-1, 1))
+        scores, idx = nd.topk(log_probs.reshape((cur_batch_size, -1)),
+                              k=beam_size, ret_typ='both')
+        beam_idx = nd.floor(idx / vocab_size)
+        tokens = idx - beam_idx * vocab_size
+        stepper.reorder((beam_idx + row_offset).reshape((-1,)))
+        decoder_input = tokens.reshape((-1,))
+
+        np_scores = scores.asnumpy()
+        np_beam_idx = beam_idx.asnumpy().astype(np.int32)
+        np_tokens = tokens.asnumpy().astype(np.int32)
+        for b in range(cur_batch_size):
+            if done[b]:
+                np_scores[b] = NEG_INF
+                continue
+            hyps[b] = [hyps[b][np_beam_idx[b, k]] + [np_tokens[b, k]]
+                       for k in range(beam_size)]
+            for k in range(beam_size):
+                if np_tokens[b, k] == eos_id and np_scores[b, k] > NEG_INF / 2:
+                    finished[b].append(
+                        (length_normalize(np_scores[b, k], step,
+                                          length_penalty), hyps[b][k][:-1]))
+                    # a finished hypothesis is not expanded any further
+                    np_scores[b, k] = NEG_INF
+            # prune the row when no alive beam can beat its best hypothesis
+            best_alive = np_scores[b].max()
+            if len(finished[b]) >= beam_size or best_alive <= NEG_INF / 2 or \
+                    (finished[b] and length_normalize(
+                        best_alive, max_test_output_len, length_penalty) <
+                     max(hyp[0] for hyp in finished[b])):
+                done[b] = True
+                np_scores[b] = NEG_INF
+        if all(done):
+            break
+        scores = nd.array(np_scores, ctx=ctx)
+
+    preds = []
+    for b in range(cur_batch_size):
+        if not finished[b]:
+            # nothing produced eos, fall back on the best alive beam
+            k = int(np_scores[b].argmax())
+            finished[b].append((np_scores[b, k], hyps[b][k]))
+        preds.append(max(finished[b], key=lambda hyp: hyp[0])[1])
+    return preds
+
+
+def batch_translate(encoder, decoder, decoder_init_state, questions,
+                    input_vocab, output_vocab, ctx, max_seq_len,
+                    max_test_output_len, batch_size=64, beam_size=1,
+                    length_penalty=0.6):
+    """ answer a list of questions, batch_size questions per forward pass
+
+    beam_size=1 decodes greedily, a larger beam trades latency for quality.
+    """
+    bos_id = output_vocab.token_to_idx[BOS]
+    eos_id = output_vocab.token_to_idx[EOS]
+    indices = questions2indices(questions, input_vocab, max_seq_len)
+    replies = []
+    for start in range(0, len(questions), batch_size):
+        inputs = nd.array(indices[start:start + batch_size], ctx=ctx)
+        if beam_size > 1:
+            preds = beam_search_decode(
+                encoder, decoder, decoder_init_state, inputs, bos_id, eos_id,
+                ctx, max_test_output_len, beam_size, length_penalty)
+        else:
+            preds = greedy_decode(encoder, decoder, decoder_init_state,
+                                  inputs, bos_id, eos_id, ctx,
+                                  max_test_output_len)
+            preds = preds.asnumpy().astype(np.int32)
+        replies.extend(indices2tokens(preds, output_vocab))
+    return replies
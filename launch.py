@@ -0,0 +1,81 @@
+""" run a training script as a local dist_sync job, for 1, 2, ... workers,
+and report the throughput and scaling efficiency of every worker count
+
+python launch.py --workers 1,2,4 seq2seq.py --epoch 1 --dataset data.txt \
+    --retrain 0 --device cpu --kvstore dist_sync
+"""
+import argparse
+import multiprocessing
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--workers", help="comma separated worker counts to run", type=str, default='1,2')
+parser.add_argument("--servers", help="number of parameter servers", type=int, default=1)
+parser.add_argument("script", help="training script and its arguments", nargs=argparse.REMAINDER)
+args = parser.parse_args()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run(command, num_workers, num_servers):
+    """ one job, returns the last samples/sec reported by each worker"""
+    env = dict(os.environ, DMLC_PS_ROOT_URI='127.0.0.1',
+               DMLC_PS_ROOT_PORT=str(free_port()),
+               DMLC_NUM_WORKER=str(num_workers),
+               DMLC_NUM_SERVER=str(num_servers))
+    # workers share the cores instead of each starting one thread per core
+    env.setdefault('OMP_NUM_THREADS', str(
+        max(1, multiprocessing.cpu_count() // num_workers)))
+    # scheduler and servers run their loop when mxnet is imported
+    others = [subprocess.Popen([sys.executable, '-c', 'import mxnet'],
+                               env=dict(env, DMLC_ROLE=role))
+              for role in ['scheduler'] + ['server'] * num_servers]
+    logs = [tempfile.TemporaryFile(mode='w+') for _ in range(num_workers)]
+    workers = []
+    try:
+        workers = [subprocess.Popen(command,
+                                    env=dict(env, DMLC_ROLE='worker'),
+                                    stdout=log, stderr=subprocess.STDOUT)
+                   for log in logs]
+        throughputs = []
+        for worker, log in zip(workers, logs):
+            code = worker.wait()
+            log.seek(0)
+            output = log.read()
+            if code != 0:
+                print(output)
+                raise SystemExit('a worker failed with exit code %d' % code)
+            throughputs.append(float(re.findall(r'([\d.]+) samples/sec',
+                                                output)[-1]))
+        for other in others:
+            other.wait()
+        return throughputs
+    finally:
+        # after a failure the other workers wait on the scheduler forever
+        for process in others + workers:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+        for log in logs:
+            log.close()
+
+
+command = [sys.executable] + args.script
+base = None
+print('workers  samples/sec  speedup  efficiency')
+for num_workers in [int(n) for n in args.workers.split(',')]:
+    throughput = sum(run(command, num_workers, args.servers))
+    if base is None:
+        base = throughput / num_workers
+    print('%7d  %11.1f  %7.2f  %9.1f%%'
+          % (num_workers, throughput, throughput / base,
+             100. * throughput / base / num_workers))
@@ -0,0 +1,83 @@
+""" load a running serve.py with concurrent clients and report the
+throughput and the latency percentiles
+
+python loadgen.py --port 8000 --concurrency 16 --requests 2000 \
+    --questions data.txt
+"""
+import argparse
+import json
+import threading
+import time
+
+import numpy as np
+
+from serving import connect, request_reply
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--host", help="address of the server", type=str, default='127.0.0.1')
+parser.add_argument("--port", help="port of the server", type=int, default=8000)
+parser.add_argument("--unix_socket", help="unix socket of the server, instead of host:port", type=str, default=None)
+parser.add_argument("--concurrency", help="clients sending at the same time", type=int, default=8)
+parser.add_argument("--requests", help="requests to time, over all clients", type=int, default=1000)
+parser.add_argument("--warmup", help="untimed requests sent first", type=int, default=20)
+parser.add_argument("--questions", help="corpus file to take the questions from, one question<sep>answer per line", type=str, default=None)
+parser.add_argument("--sep", help="separator of question and answer", type=str, default='@')
+args = parser.parse_args()
+
+questions = ['hello', 'how are you ?', 'what is your name ?',
+             'where are you from ?']
+if args.questions is not None:
+    with open(args.questions, encoding='utf8') as f:
+        questions = [line.split(args.sep)[0] for line in f if line.strip()]
+
+
+def client(num_requests, offset, latencies):
+    """ send num_requests questions one after another on one connection"""
+    connection = connect(args.host, args.port, args.unix_socket)
+    for i in range(num_requests):
+        question = questions[(offset + i) % len(questions)]
+        tic = time.perf_counter()
+        request_reply(connection, question)
+        latencies.append(time.perf_counter() - tic)
+    connection.close()
+
+
+def run(num_requests):
+    """ latencies of num_requests spread over the clients, and wall time"""
+    latencies = []
+    threads = [threading.Thread(target=client, args=(
+        num_requests // args.concurrency +
+        (i < num_requests % args.concurrency), i * 7919, latencies))
+        for i in range(args.concurrency)]
+    tic = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return np.array(latencies), time.perf_counter() - tic
+
+
+def server_stats():
+    connection = connect(args.host, args.port, args.unix_socket)
+    connection.request('GET', '/stats')
+    stats = json.loads(connection.getresponse().read().decode())
+    connection.close()
+    return stats
+
+
+run(args.warmup)
+before = server_stats()
+latencies, seconds = run(args.requests)
+after = server_stats()
+print('%d requests, %d clients, %.1f s' % (len(latencies), args.concurrency,
+                                          seconds))
+print('qps %.1f' % (len(latencies) / seconds))
+print('latency ms p50 %.1f  p90 %.1f  p99 %.1f  max %.1f' % tuple(
+    1000 * np.percentile(latencies, [50, 90, 99, 100])))
+print('server mean batch size %.2f' % (
+    (after['requests'] - before['requests']) /
+    float(max(after['batches'] - before['batches'], 1))))
+if 'cache' in after:
+    hits = after['cache']['hits'] - before['cache']['hits']
+    misses = after['cache']['misses'] - before['cache']['misses']
+    print('cache hit rate %.1f%%' % (100. * hits / max(hits + misses, 1)))
@@ -0,0 +1,488 @@
+import os
+import tempfile
+
+import numpy as np
+from mxnet import autograd, nd
+from mxnet.gluon import nn, rnn
+
+from precision import amp_initialized
+
+
+class Encoder(nn.HybridBlock):
+    """ encoder"""
+    def __init__(self, num_inputs, num_hiddens, num_layers, drop_prob,
+                 **kwargs):
+        super(Encoder, self).__init__(**kwargs)
+        with self.name_scope():
+            self.embedding = nn.Embedding(num_inputs, num_hiddens)
+            self.dropout = nn.Dropout(drop_prob)
+            self.rnn = rnn.GRU(num_hiddens, num_layers, dropout=drop_prob,
+                               input_size=num_hiddens)
+
+    def hybrid_forward(self, F, inputs, state):
+        embedding = F.swapaxes(self.embedding(inputs), 0, 1)
+        embedding = self.dropout(embedding)
+        output, state = self.rnn(embedding, state)
+        return output, state
+
+    def begin_state(self, *args, **kwargs):
+        return self.rnn.begin_state(*args, **kwargs)
+
+
+class AdditiveAttention(nn.HybridBlock):
+    """ additive (bahdanau) attention
+
+    score = v * tanh(W_k * encoder_output + W_q * hidden), the encoder side
+    W_k * encoder_output only depends on the question, so it is projected
+    once per sequence by `keys` and reused on every decoding step.
+    """
+    def __init__(self, alignment_size, query_size, key_size, **kwargs):
+        super(AdditiveAttention, self).__init__(**kwargs)
+        with self.name_scope():
+            self.key = nn.Dense(alignment_size, in_units=key_size,
+                                flatten=False)
+            self.query = nn.Dense(alignment_size, in_units=query_size,
+                                  use_bias=False, flatten=False)
+            self.score = nn.Dense(1, in_units=alignment_size, flatten=False)
+
+    def keys(self, encoder_outputs):
+        # (max_seq_len, batch, encoder_num_hiddens) -> (max_seq_len, batch,
+        # alignment_size)
+        return self.key(encoder_outputs)
+
+    def hybrid_forward(self, F, keys, hidden):
+        # hidden is (1, batch, num_hiddens), broadcast over max_seq_len
+        energy = F.tanh(F.broadcast_add(keys, self.query(hidden)))
+        return self.score(energy)
+
+
+class Decoder(nn.HybridBlock):
+    """ decoder with attention
+
+    embedding_params shares the embedding of another block (the encoder's,
+    over a joint vocabulary), tie_output makes the output projection use
+    the embedding matrix as its weight.
+    """
+    def __init__(self, num_hiddens, num_outputs, num_layers, max_seq_len,
+                 drop_prob, alignment_size, encoder_num_hiddens,
+                 embedding_params=None, tie_output=False, **kwargs):
+        super(Decoder, self).__init__(**kwargs)
+        self.max_seq_len = max_seq_len
+        self.encoder_num_hiddens = encoder_num_hiddens
+        self.hidden_size = num_hiddens
+        self.num_layers = num_layers
+        with self.name_scope():
+            self.embedding = nn.Embedding(num_outputs, num_hiddens,
+                                          params=embedding_params)
+            self.dropout = nn.Dropout(drop_prob)
+            # attention model
+            self.attention = AdditiveAttention(alignment_size, num_hiddens,
+                                               encoder_num_hiddens)
+            self.rnn = rnn.GRU(num_hiddens, num_layers, dropout=drop_prob,
+                               input_size=num_hiddens)
+            # the (num_outputs, num_hiddens) weight has the embedding shape
+            self.out = nn.Dense(num_outputs, in_units=num_hiddens,
+                                flatten=False,
+                                params=self.embedding.params if tie_output
+                                else None)
+            self.rnn_concat_input = nn.Dense(
+                num_hiddens, in_units=num_hiddens + encoder_num_hiddens,
+                flatten=False)
+
+    def attention_keys(self, encoder_outputs):
+        """ project the encoder outputs once, before the first step"""
+        # the sequence length is copied from the input (0), batches may be
+        # shorter than max_seq_len
+        encoder_outputs = encoder_outputs.reshape(
+            (0, -1, self.encoder_num_hiddens))
+        return self.attention.keys(encoder_outputs)
+
+    def hybrid_forward(self, F, cur_input, state, encoder_outputs,
+                       encoder_keys):
+        batch_encoder_outputs = F.swapaxes(F.reshape(
+            encoder_outputs, shape=(0, -1, self.encoder_num_hiddens)), 0, 1)
+        output, state = self._step(F, self.embedding(cur_input), state,
+                                   batch_encoder_outputs, encoder_keys)
+        output = self.dropout(output)
+        output = F.reshape(self.out(output), shape=(-3, -1))
+        return output, state
+
+    def _step(self, F, embedding, state, batch_encoder_outputs,
+              encoder_keys, rnn_params=None):
+        """ attention and one GRU step, before the output projection
+
+        rnn_params are the GRU params packed by packed_rnn_params, without
+        them the GRU layer packs them itself.
+        """
+        # get the layer whitch is close output
+        single_layer_state = [F.slice_axis(state[0], axis=0, begin=-1,
+                                           end=None)]
+        energy = self.attention(encoder_keys, single_layer_state[0])
+        batch_attention = F.transpose(F.softmax(energy, axis=0),
+                                      axes=(1, 2, 0))
+        decoder_context = F.batch_dot(batch_attention, batch_encoder_outputs)
+        input_and_context = F.concat(F.expand_dims(embedding, axis=1),
+                                     decoder_context, dim=2)
+        concat_input = F.reshape(self.rnn_concat_input(input_and_context),
+                                 shape=(1, -1, 0))
+        concat_input = self.dropout(concat_input)
+        state = [F.broadcast_axis(single_layer_state[0], axis=0,
+                                  size=self.num_layers)]
+        if rnn_params is None:
+            return self.rnn(concat_input, state)
+        output, state = F.RNN(concat_input, rnn_params, state[0],
+                              state_size=self.hidden_size,
+                              num_layers=self.num_layers, mode='gru',
+                              p=self.rnn._dropout, state_outputs=True)
+        return output, [state]
+
+    def unroll(self, inputs, state, encoder_outputs, encoder_keys,
+               project=True):
+        """ decode a known (batch, num_steps) input sequence, teacher forcing
+
+        the attention query is the hidden state of the step before, so only
+        attention and the GRU run step by step, the embedding lookup and the
+        output projection run once over all steps, the GRU params are
+        packed once. returns
+        (num_steps, batch, num_outputs) outputs, or the
+        (num_steps, batch, num_hiddens) hidden states when not project.
+        """
+        embeddings = self.embedding(inputs)
+        batch_encoder_outputs = nd.swapaxes(nd.reshape(
+            encoder_outputs, shape=(0, -1, self.encoder_num_hiddens)), 0, 1)
+        rnn_params = packed_rnn_params(self.rnn, inputs.context)
+        outputs = []
+        for i in range(inputs.shape[1]):
+            output, state = self._step(nd, embeddings[:, i], state,
+                                       batch_encoder_outputs, encoder_keys,
+                                       rnn_params)
+            outputs.append(output)
+        outputs = self.dropout(nd.concat(*outputs, dim=0))
+        if not project:
+            return outputs, state
+        return self.out(outputs), state
+
+    def begin_state(self, *args, **kwargs):
+        return self.rnn.begin_state(*args, **kwargs)
+
+    def load_params(self, filename, *args, **kwargs):
+        """ load params, also from checkpoints of the concat attention"""
+        loaded = nd.load(filename)
+        if 'sequential0_dense0_weight' not in loaded:
+            return super(Decoder, self).load_params(filename, *args, **kwargs)
+        fd, converted = tempfile.mkstemp(suffix='.params')
+        os.close(fd)
+        try:
+            nd.save(converted, convert_legacy_attention(loaded, self))
+            return super(Decoder, self).load_params(converted, *args,
+                                                    **kwargs)
+        finally:
+            os.remove(converted)
+
+
+def convert_legacy_attention(params, decoder):
+    """ map the concat attention weights onto AdditiveAttention
+
+    the old first Dense works on concat(encoder_output, hidden), so its
+    weight splits column-wise into the key and the query projection.
+    """
+    def name(param):
+        # saved names have the decoder prefix stripped
+        return param.name[len(decoder.prefix):]
+
+    attention = decoder.attention
+    params = dict(params)
+    weight = params.pop('sequential0_dense0_weight')
+    params[name(attention.key.weight)] = nd.slice_axis(
+        weight, axis=1, begin=0, end=decoder.encoder_num_hiddens)
+    params[name(attention.key.bias)] = params.pop('sequential0_dense0_bias')
+    params[name(attention.query.weight)] = nd.slice_axis(
+        weight, axis=1, begin=decoder.encoder_num_hiddens, end=None)
+    params[name(attention.score.weight)] = \
+        params.pop('sequential0_dense1_weight')
+    params[name(attention.score.bias)] = params.pop('sequential0_dense1_bias')
+    return params
+
+
+def packed_rnn_params(rnn_layer, ctx):
+    """ the flat param vector of the fused RNN operator, in gluon's order
+
+    the gluon layer concatenates it on every call, a step loop can pack it
+    once per sequence instead.
+    """
+    return nd.concat(*[
+        rnn_layer._reg_params['l%d_%s_%s' % (layer, gate, kind)]
+        .data(ctx).reshape((-1,))
+        for kind in ('weight', 'bias')
+        for layer in range(rnn_layer._num_layers)
+        for gate in ('i2h', 'h2h')], dim=0)
+
+
+class IncrementalDecoder(object):
+    """ run a Decoder one step at a time on preallocated buffers
+
+    begin() allocates the buffers for a batch and does the per sequence
+    work once: the batch-major encoder outputs and the packed GRU params.
+    every step() then writes the embedding, attention, GRU input, state and
+    output into the same arrays with out=, nothing is allocated per step.
+    inference only, autograd can not record writes into existing arrays.
+    the outputs of a step are overwritten by the next one.
+
+    amp casts the out= arrays of the operators it wraps to their run dtype,
+    the results then never reach the buffers. with amp the steps call the
+    Decoder block instead.
+    """
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.use_block = amp_initialized()
+
+    def begin(self, encoder_outputs, encoder_keys, state, ctx):
+        """ encoder_outputs and keys are (max_seq_len, batch, size), state
+        is the decoder state list, which stays intact
+        """
+        decoder = self.decoder
+        if self.use_block:
+            self.encoder_outputs = encoder_outputs.flatten()
+            self.encoder_keys = encoder_keys
+            self.state = state
+            return self
+        seq_len, batch_size = encoder_outputs.shape[:2]
+        num_layers, hidden_size = decoder.num_layers, decoder.hidden_size
+        dtype = encoder_outputs.dtype
+
+        def empty(*shape):
+            return nd.empty(shape, ctx=ctx, dtype=dtype)
+        self.batch_encoder_outputs = nd.swapaxes(encoder_outputs, 0, 1)
+        self.encoder_keys = encoder_keys
+        self.rnn_params = packed_rnn_params(decoder.rnn, ctx)
+        self.weights = {name: param.data(ctx) for name, param in [
+            ('embedding', decoder.embedding.weight),
+            ('query', decoder.attention.query.weight),
+            ('score', decoder.attention.score.weight),
+            ('score_bias', decoder.attention.score.bias),
+            ('concat', decoder.rnn_concat_input.weight),
+            ('concat_bias', decoder.rnn_concat_input.bias),
+            ('out', decoder.out.weight), ('out_bias', decoder.out.bias)]}
+        self.num_outputs = self.weights['out'].shape[0]
+        # a step reads the top layer only, the initial state may come with
+        # the number of encoder layers
+        initial = state[0][state[0].shape[0] - 1:state[0].shape[0]]
+        self.state = empty(num_layers, batch_size, hidden_size)
+        nd.broadcast_axis(initial, axis=0, size=num_layers, out=self.state)
+        self._next_state = empty(num_layers, batch_size, hidden_size)
+        self._embedding = empty(batch_size, hidden_size)
+        self._query = empty(1, batch_size, encoder_keys.shape[2])
+        self._energy = empty(*encoder_keys.shape)
+        self._score = empty(seq_len, batch_size, 1)
+        self._attention = empty(seq_len, batch_size, 1)
+        self._batch_attention = empty(batch_size, 1, seq_len)
+        self._context = empty(batch_size, 1, encoder_outputs.shape[2])
+        self._input_and_context = empty(
+            batch_size, 1, hidden_size + encoder_outputs.shape[2])
+        self._rnn_input = empty(batch_size, 1, hidden_size)
+        self._rnn_state = empty(num_layers, batch_size, hidden_size)
+        self._output = empty(1, batch_size, hidden_size)
+        self._logits = empty(1, batch_size, self.num_outputs)
+        return self
+
+    def step(self, inputs):
+        """ (batch, num_outputs) scores of the next token after inputs"""
+        if self.use_block:
+            output, self.state = self.decoder(
+                inputs, self.state, self.encoder_outputs, self.encoder_keys)
+            return output
+        decoder, w = self.decoder, self.weights
+        batch_size, hidden_size = self._embedding.shape
+        nd.Embedding(inputs, w['embedding'], input_dim=w['embedding'].shape[0],
+                     output_dim=hidden_size, out=self._embedding)
+        # the layer closest to the output is the attention query and the
+        # state of every layer of the step
+        top = self.state[decoder.num_layers - 1:decoder.num_layers]
+        nd.FullyConnected(top, w['query'], no_bias=True,
+                          num_hidden=w['query'].shape[0], flatten=False,
+                          out=self._query)
+        nd.broadcast_add(self.encoder_keys, self._query, out=self._energy)
+        nd.tanh(self._energy, out=self._energy)
+        nd.FullyConnected(self._energy, w['score'], w['score_bias'],
+                          num_hidden=1, flatten=False, out=self._score)
+        nd.softmax(self._score, axis=0, out=self._attention)
+        nd.transpose(self._attention, axes=(1, 2, 0),
+                     out=self._batch_attention)
+        nd.batch_dot(self._batch_attention, self.batch_encoder_outputs,
+                     out=self._context)
+        nd.concat(self._embedding.reshape((batch_size, 1, hidden_size)),
+                  self._context, dim=2, out=self._input_and_context)
+        nd.FullyConnected(self._input_and_context, w['concat'],
+                          w['concat_bias'], num_hidden=hidden_size,
+                          flatten=False, out=self._rnn_input)
+        nd.broadcast_axis(top, axis=0, size=decoder.num_layers,
+                          out=self._rnn_state)
+        # (batch, 1, hidden) has the memory layout of (1, batch, hidden)
+        nd.RNN(self._rnn_input.reshape((1, batch_size, hidden_size)),
+               self.rnn_params, self._rnn_state, state_size=hidden_size,
+               num_layers=decoder.num_layers, mode='gru', state_outputs=True,
+               out=[self._output, self._next_state])
+        self.state, self._next_state = self._next_state, self.state
+        nd.FullyConnected(self._output, w['out'], w['out_bias'],
+                          num_hidden=self.num_outputs, flatten=False,
+                          out=self._logits)
+        return self._logits.reshape((batch_size, self.num_outputs))
+
+    def reorder(self, index):
+        """ keep the state rows of index, as beam search does every step"""
+        if self.use_block:
+            self.state = [nd.take(s, index, axis=1) for s in self.state]
+            return
+        nd.take(self.state, index, axis=1, out=self._next_state)
+        self.state, self._next_state = self._next_state, self.state
+
+
+class DecoderInitState(nn.HybridBlock):
+
+    def __init__(self, encoder_num_hiddens, decoder_num_hiddens, **kwargs):
+        super(DecoderInitState, self).__init__(**kwargs)
+        with self.name_scope():
+            self.dense = nn.Dense(decoder_num_hiddens,
+                                  in_units=encoder_num_hiddens,
+                                  activation="tanh", flatten=False)
+
+    def hybrid_forward(self, F, encoder_state):
+        return [self.dense(encoder_state)]
+
+
+def hybridize_models(*blocks, static_shape=True):
+    """ compile the blocks into static symbolic graphs
+
+    static_shape plans the memory of the graph once, for callers whose
+    input shapes do not change between calls. with varying shapes (length
+    buckets, batches of any size) every new shape would plan it again.
+    """
+    for block in blocks:
+        block.hybridize(static_alloc=True, static_shape=static_shape)
+
+
+class UnigramSampler(object):
+    """ negatives of a sampled softmax, drawn with replacement from the
+    token counts raised to power (0.75 flattens them like word2vec), with
+    rng (a numpy RandomState, the global one when None)
+    """
+    def __init__(self, counts, num_sampled, power=0.75, rng=None):
+        # every index can be drawn, labels never have a zero probability
+        probs = np.maximum(counts, 1).astype(np.float64) ** power
+        probs /= probs.sum()
+        self.num_sampled = num_sampled
+        self.cdf = np.cumsum(probs)
+        self.log_expected = np.log(probs * num_sampled).astype(np.float32)
+        self._log_expected = {}
+        self._rng = np.random if rng is None else rng
+
+    def __call__(self, ctx):
+        """ sampled indices and the log expected count of every index"""
+        if ctx not in self._log_expected:
+            self._log_expected[ctx] = nd.array(self.log_expected, ctx=ctx)
+        sampled = np.searchsorted(self.cdf, self._rng.uniform(
+            high=self.cdf[-1], size=self.num_sampled))
+        return nd.array(sampled, ctx=ctx), self._log_expected[ctx]
+
+
+class Seq2Seq(nn.Block):
+    """ encoder, decoder and decoder_init_state as one block
+
+    one collect_params() for a single Trainer, and one checkpoint file.
+    with a sampler, teacher forced training scores the label against
+    sampler.num_sampled negatives instead of the whole vocabulary.
+    """
+    def __init__(self, encoder, decoder, decoder_init_state, bos_id, eos_id,
+                 sampler=None, **kwargs):
+        super(Seq2Seq, self).__init__(**kwargs)
+        self.encoder = encoder
+        self.decoder = decoder
+        self.decoder_init_state = decoder_init_state
+        self.bos_id = bos_id
+        self.eos_id = eos_id
+        self.sampler = sampler
+
+    def forward(self, x, y, loss, teacher_forcing=False):
+        """ loss of a batch averaged over the answer tokens up to eos
+
+        the decoder is fed its own predictions, or with teacher_forcing the
+        gold answer shifted by one step. returns the loss and the number of
+        tokens it is averaged over.
+        """
+        ctx = x.context
+        cur_batch_size = x.shape[0]
+        l = nd.array([0], ctx=ctx)
+        valid_length = nd.array([0], ctx=ctx)
+        encoder_state = self.encoder.begin_state(
+            func=nd.zeros, batch_size=cur_batch_size, ctx=ctx)
+        encoder_outputs, encoder_state = self.encoder(x, encoder_state)
+        encoder_outputs = encoder_outputs.flatten()
+        encoder_keys = self.decoder.attention_keys(encoder_outputs)
+        # use bos as init on decoder
+        decoder_input = nd.full((cur_batch_size,), self.bos_id, ctx=ctx)
+        mask = nd.ones(shape=(cur_batch_size,), ctx=ctx)
+        decoder_state = self.decoder_init_state(encoder_state[0])
+        if teacher_forcing:
+            return self._teacher_forcing_loss(
+                y, loss, decoder_input, decoder_state, encoder_outputs,
+                encoder_keys)
+        # the batch is only padded to its bucket length
+        for i in range(y.shape[1]):
+            decoder_output, decoder_state = self.decoder(
+                decoder_input, decoder_state, encoder_outputs, encoder_keys)
+            # use decoder current predict for next state input
+            decoder_input = decoder_output.argmax(axis=1)
+            valid_length = valid_length + mask.sum()
+            l = l + (mask * loss(decoder_output, y[:, i])).sum()
+            mask = mask * (y[:, i] != self.eos_id)
+        return l / valid_length, valid_length
+
+    def _teacher_forcing_loss(self, y, loss, bos, decoder_state,
+                              encoder_outputs, encoder_keys):
+        num_steps = y.shape[1]
+        decoder_inputs = nd.concat(bos.reshape((-1, 1)),
+                                   nd.slice_axis(y, axis=1, begin=0,
+                                                 end=num_steps - 1), dim=1)
+        # free running batches need every logit for the argmax they feed
+        # back, teacher forced ones only for the loss
+        sampled = self.sampler is not None and autograd.is_training()
+        outputs, _ = self.decoder.unroll(decoder_inputs, decoder_state,
+                                         encoder_outputs, encoder_keys,
+                                         project=not sampled)
+        labels = y.T
+        # every row has one eos, the tokens up to it count
+        eos_steps = nd.argmax(labels == self.eos_id, axis=0)
+        mask = nd.broadcast_lesser_equal(
+            nd.arange(num_steps, ctx=y.context).reshape((-1, 1)),
+            eos_steps.reshape((1, -1)))
+        if sampled:
+            l = self._sampled_loss(outputs.reshape((-3, -1)),
+                                   labels.reshape((-1,)), loss)
+        else:
+            l = loss(outputs.reshape((-3, -1)), labels.reshape((-1,)))
+        valid_length = mask.sum().reshape((1,))
+        l = (mask.reshape((-1,)) * l).sum().reshape((1,))
+        return l / valid_length, valid_length
+
+    def _sampled_loss(self, hidden, labels, loss):
+        """ softmax loss of the label against the sampled negatives
+
+        the logits are corrected by the log expected count of each index
+        under the sampler, negatives equal to the label are masked out.
+        """
+        ctx = hidden.context
+        sampled, log_expected = self.sampler(ctx)
+        weight = self.decoder.out.weight.data(ctx)
+        bias = self.decoder.out.bias.data(ctx)
+        true_logits = (hidden * nd.take(weight, labels)).sum(axis=1) \
+            + nd.take(bias - log_expected, labels)
+        sampled_logits = nd.FullyConnected(
+            hidden, nd.take(weight, sampled),
+            nd.take(bias - log_expected, sampled),
+            num_hidden=self.sampler.num_sampled)
+        hits = nd.broadcast_equal(labels.reshape((-1, 1)),
+                                  sampled.reshape((1, -1)))
+        logits = nd.concat(true_logits.reshape((-1, 1)),
+                           sampled_logits - hits * 1e9, dim=1)
+        # the label is the first column
+        return loss(logits, nd.zeros_like(labels))
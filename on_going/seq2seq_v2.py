@@ -1,16 +1,19 @@
-import collections
-import mxnet as mx
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 from mxnet import autograd, gluon, init, nd
-from mxnet.contrib import text
 from mxnet.gluon import data as gdata, loss as gloss, nn, rnn
 import numpy as np
 import argparse
+from corpus import load_corpus, tensorize
+from device import add_device_arguments, select_contexts
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--wname", help="name of weighting", type=str)
 parser.add_argument("--epoch", help="number of epochs", type=int)
 parser.add_argument("--dataset", help="name of dataset", type=str)
 parser.add_argument("--retrain", help="load weighting and continue training", type=int)
+add_device_arguments(parser)
 
 args = parser.parse_args()
 
@@ -37,39 +40,7 @@ decoder_drop_prob = 0.1
 encoder_num_hiddens = 256
 decoder_num_hiddens = 256
 alignment_size = 25
-ctx = mx.cpu(0)
-
-
-def read_data(dataset, max_seq_len):
-    input_tokens = []
-    output_tokens = []
-    input_seqs = []
-    output_seqs = []
-    with open(dataset, 'r') as f:
-        lines = f.readlines()
-        for line in lines[:20]:
-            input_seq, output_seq = line.rstrip().split('\t')
-            cur_input_tokens = input_seq.split(' ')
-            cur_output_tokens = output_seq.split(' ')
-            if len(cur_input_tokens) < max_seq_len and \
-                    len(cur_output_tokens) < max_seq_len:
-                input_tokens.extend(cur_input_tokens)
-                # add eos in end of seq
-                cur_input_tokens.append(EOS)
-                # use pad for each seq make them have same length
-                while len(cur_input_tokens) < max_seq_len:
-                    cur_input_tokens.append(PAD)
-                input_seqs.append(cur_input_tokens)
-                output_tokens.extend(cur_output_tokens)
-                cur_output_tokens.append(EOS)
-                while len(cur_output_tokens) < max_seq_len:
-                    cur_output_tokens.append(PAD)
-                output_seqs.append(cur_output_tokens)
-        fr_vocab = text.vocab.Vocabulary(collections.Counter(input_tokens),
-                                         reserved_tokens=[PAD, BOS, EOS])
-        en_vocab = text.vocab.Vocabulary(collections.Counter(output_tokens),
-                                         reserved_tokens=[PAD, BOS, EOS])
-    return fr_vocab, en_vocab, input_seqs, output_seqs
+ctx = select_contexts(args.device, args.cpu_threads)[0]
 
 
 class Encoder(nn.Block):
@@ -277,14 +248,10 @@ def train(encoder, decoder, decoder_init_state, max_seq_len, ctx, retrain, test)
         decoder_init_state.save_params(wd_init)
 
 
-input_vocab, output_vocab, input_seqs, output_seqs = read_data(dataset, max_seq_len)
-Q = nd.zeros((len(input_seqs), max_seq_len), ctx=ctx)
-A = nd.zeros((len(output_seqs), max_seq_len), ctx=ctx)
-for i in range(len(input_seqs)):
-    Q[i] = nd.array(input_vocab.to_indices(input_seqs[i]), ctx=ctx)
-    A[i] = nd.array(output_vocab.to_indices(output_seqs[i]), ctx=ctx)
-
-dataset = gdata.ArrayDataset(Q, A)
+input_vocab, output_vocab, input_indices, output_indices, QA_pair = \
+    load_corpus(dataset, max_seq_len, sep='\t', max_lines=20,
+                keep_pairs=True)
+dataset = tensorize(input_indices, output_indices, ctx)
 loss = gloss.SoftmaxCrossEntropyLoss()
 eos_id = output_vocab.token_to_idx[EOS]
 
@@ -296,13 +263,6 @@ decoder = Decoder(decoder_num_hiddens, len(output_vocab),
 decoder_init_state = DecoderInitState(encoder_num_hiddens,
                                       decoder_num_hiddens)
 
-QA_pair = []
-with open(args.dataset, 'r') as f:
-    pair = f.readlines()
-
-for i in pair:
-    q, a = i.split('\t')
-    QA_pair.append([q, a[:-1]])
 print(QA_pair)
 
 # eval_fr_ens =[['Can we make this quick?  Roxanne Korrine and Andrew Barrett are having an incredibly horrendous public break- up on the quad.  Again.',
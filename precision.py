@@ -0,0 +1,46 @@
+""" mixed precision, float16 on the gpu and bfloat16 on the cpu
+
+amp wraps the operators when it is initialized, so init_amp has to run
+before the blocks are built. the operators on the amp lists (FullyConnected,
+the vocabulary projection included) then run in low precision while the
+params, the master weights of the optimizer, stay float32.
+"""
+import contextlib
+
+from mxnet.contrib import amp
+
+
+def amp_dtype(ctx):
+    # float16 FullyConnected only exists on cuda, mkl-dnn has bfloat16
+    return 'float16' if ctx.device_type == 'gpu' else 'bfloat16'
+
+
+def amp_initialized():
+    """ whether init_amp (amp.init) wrapped the operators"""
+    return amp.amp._amp_initialized
+
+
+def init_amp(ctx):
+    """ switch training and inference to mixed precision, returns the dtype"""
+    dtype = amp_dtype(ctx)
+    amp.init(target_dtype=dtype)
+    return dtype
+
+
+def init_amp_trainer(trainer, dtype):
+    """ dynamic loss scaling, bfloat16 has the float32 range and needs none"""
+    if dtype == 'float16':
+        amp.init_trainer(trainer)
+
+
+@contextlib.contextmanager
+def scale_loss(losses, trainer):
+    """ the losses to run backward on, scaled when the trainer has a scaler
+
+    steps whose gradients overflow are skipped and the scale is halved.
+    """
+    if getattr(trainer, '_amp_loss_scaler', None) is None:
+        yield losses
+    else:
+        with amp.scale_loss(losses, trainer) as scaled:
+            yield scaled
@@ -1,18 +1,47 @@
-import collections
-import io
 import mxnet as mx
-from mxnet import autograd, gluon, init, nd
-from mxnet.contrib import text
-from mxnet.gluon import data as gdata, loss as gloss, nn, rnn
+from mxnet import autograd, init, nd
+from mxnet.gluon import data as gdata, loss as gloss
+import numpy as np
+from checkpoint import CheckpointManager, save_model_info
+from corpus import (IndexDataset, RandomSampler, bucket_loader, coverage,
+                    load_corpus, tensorize, token_counts)
+from device import add_device_arguments, select_contexts
+from inference import batch_translate
+from model import (Decoder, DecoderInitState, Encoder, Seq2Seq,
+                   UnigramSampler, hybridize_models)
+from precision import init_amp, init_amp_trainer, scale_loss
+from training import make_trainer, split_batch, step, teacher_forcing_ratio
 
 import argparse
+import os
+import random
+import time
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument("--epoch", help="number of epochs", type=int)
 parser.add_argument("--dataset", help="name of dataset",type=str)
 parser.add_argument("--retrain", help="ccc weighting and continue training",type=int)
+parser.add_argument("--beam_size", help="beam width of translate, 1 is greedy", type=int, default=1)
+parser.add_argument("--hybridize", help="compile the models into symbolic graphs", type=int, default=1)
+parser.add_argument("--cache_dir", help="directory of the tokenized corpus cache", type=str, default='corpus_cache')
+parser.add_argument("--mmap", help="read batches from the memory-mapped corpus cache instead of keeping it on the device", type=int, default=0)
+parser.add_argument("--buckets", help="number of length buckets, 0 pads every batch to max_seq_len", type=int, default=0)
+parser.add_argument("--optimizer", help="optimizer of the encoder, decoder and decoder init state", type=str, default='adam')
+parser.add_argument("--clip", help="clip the gradients to this global norm, 0 does not clip", type=float, default=0)
+parser.add_argument("--teacher_forcing", help="share of batches fed the gold answer on the first epoch, decays to 0 (scheduled sampling)", type=float, default=0)
+parser.add_argument("--kvstore", help="gradient aggregation, device for one process, dist_sync for several workers", type=str, default='device')
+parser.add_argument("--keep_checkpoints", help="number of latest checkpoints to keep besides the best one", type=int, default=3)
+parser.add_argument("--amp", help="mixed precision, float16 on gpu and bfloat16 on cpu, with float32 master weights", type=int, default=0)
+parser.add_argument("--sampled_softmax", help="negatives of a sampled softmax, 0 uses the full softmax. only the teacher forced share of batches (--teacher_forcing, decaying over the epochs) samples, the others run the full softmax", type=int, default=0)
+parser.add_argument("--min_freq", help="tokens seen fewer times map to <unk>", type=int, default=1)
+parser.add_argument("--max_vocab", help="rows of each vocabulary, the rarer tokens map to <unk>, 0 keeps them all", type=int, default=0)
+parser.add_argument("--tie_embeddings", help="1 builds one joint vocabulary, one embedding serves the encoder, the decoder and the output layer", type=int, default=0)
+add_device_arguments(parser)
 args = parser.parse_args()
+if args.sampled_softmax > 0 and args.teacher_forcing == 0:
+    parser.error('--sampled_softmax only applies to teacher forced batches, '
+                 'it needs --teacher_forcing > 0')
 
 
 PAD = '<pad>'
@@ -22,6 +51,21 @@ EOS = '<eos>'
 epochs = args.epoch
 dataset = args.dataset
 retrain = args.retrain
+beam_size = args.beam_size
+hybridize = args.hybridize
+cache_dir = args.cache_dir
+mmap = args.mmap
+buckets = args.buckets
+optimizer = args.optimizer
+clip = args.clip
+teacher_forcing = args.teacher_forcing
+kvstore = args.kvstore
+keep_checkpoints = args.keep_checkpoints
+use_amp = args.amp
+sampled_softmax = args.sampled_softmax
+min_freq = args.min_freq
+max_vocab = args.max_vocab or None
+tie_embeddings = args.tie_embeddings
 epoch_period = 10
 lr = 0.005
 batch_size = 2
@@ -36,263 +80,167 @@ decoder_drop_prob = 0.1
 encoder_num_hiddens = 256
 decoder_num_hiddens = 256
 alignment_size = 25
-ctx = mx.gpu(0)
-
-def read_data(dataset,max_seq_len):
-    input_tokens = []
-    output_tokens = []
-    input_seqs = []
-    output_seqs = []
-    with open(dataset,'r') as f:
-        lines = f.readlines()
-        for line in lines[:20]:
-            input_seq, output_seq = line.rstrip().split('@')
-            cur_input_tokens = input_seq.split(' ')
-            cur_output_tokens = output_seq.split(' ')
-            if len(cur_input_tokens) < max_seq_len and \
-                    len(cur_output_tokens) < max_seq_len:
-                input_tokens.extend(cur_input_tokens)
-                # add eos in end of seq
-                cur_input_tokens.append(EOS)
-                # use pad for each seq make them have same length
-                while len(cur_input_tokens) < max_seq_len:
-                    cur_input_tokens.append(PAD)
-                input_seqs.append(cur_input_tokens)
-                output_tokens.extend(cur_output_tokens)
-                cur_output_tokens.append(EOS)
-                while len(cur_output_tokens) < max_seq_len:
-                    cur_output_tokens.append(PAD)
-                output_seqs.append(cur_output_tokens)
-        fr_vocab = text.vocab.Vocabulary(collections.Counter(input_tokens),
-                                         reserved_tokens=[PAD, BOS, EOS])
-        en_vocab = text.vocab.Vocabulary(collections.Counter(output_tokens),
-                                         reserved_tokens=[PAD, BOS, EOS])
-    return fr_vocab, en_vocab, input_seqs, output_seqs
-
-class Encoder(nn.Block):
-    """ encoder"""
-    def __init__(self, num_inputs, num_hiddens, num_layers, drop_prob,
-                 **kwargs):
-        super(Encoder, self).__init__(**kwargs)
-        with self.name_scope():
-            self.embedding = nn.Embedding(num_inputs, num_hiddens)
-            self.dropout = nn.Dropout(drop_prob)
-            self.rnn = rnn.GRU(num_hiddens, num_layers, dropout=drop_prob,
-                               input_size=num_hiddens)
-
-    def forward(self, inputs, state):
-        embedding = self.embedding(inputs).swapaxes(0, 1)
-        embedding = self.dropout(embedding)
-        output, state = self.rnn(embedding, state)
-        return output, state
-
-    def begin_state(self, *args, **kwargs):
-        return self.rnn.begin_state(*args, **kwargs)
-
-class Decoder(nn.Block):
-    """含注意力机制的解码器。"""
-    def __init__(self, num_hiddens, num_outputs, num_layers, max_seq_len,
-                 drop_prob, alignment_size, encoder_num_hiddens, **kwargs):
-        super(Decoder, self).__init__(**kwargs)
-        self.max_seq_len = max_seq_len
-        self.encoder_num_hiddens = encoder_num_hiddens
-        self.hidden_size = num_hiddens
-        self.num_layers = num_layers
-        with self.name_scope():
-            self.embedding = nn.Embedding(num_outputs, num_hiddens)
-            self.dropout = nn.Dropout(drop_prob)
-            # 注意力机制。
-            self.attention = nn.Sequential()
-            with self.attention.name_scope():
-                self.attention.add(
-                    nn.Dense(alignment_size,
-                             in_units=num_hiddens + encoder_num_hiddens,
-                             activation="tanh", flatten=False))
-                self.attention.add(nn.Dense(1, in_units=alignment_size,
-                                            flatten=False))
-
-            self.rnn = rnn.GRU(num_hiddens, num_layers, dropout=drop_prob,
-                               input_size=num_hiddens)
-            self.out = nn.Dense(num_outputs, in_units=num_hiddens,
-                                flatten=False)
-            self.rnn_concat_input = nn.Dense(
-                num_hiddens, in_units=num_hiddens + encoder_num_hiddens,
-                flatten=False)
-
-    def forward(self, cur_input, state, encoder_outputs):
-        # 当 RNN 为多层时，取最靠近输出层的单层隐藏状态。
-        single_layer_state = [state[0][-1].expand_dims(0)]
-        encoder_outputs = encoder_outputs.reshape((self.max_seq_len, -1,
-                                                   self.encoder_num_hiddens))
-        hidden_broadcast = nd.broadcast_axis(single_layer_state[0], axis=0,
-                                             size=self.max_seq_len)
-        encoder_outputs_and_hiddens = nd.concat(encoder_outputs,
-                                                hidden_broadcast, dim=2)
-        energy = self.attention(encoder_outputs_and_hiddens)
-        batch_attention = nd.softmax(energy, axis=0).transpose((1, 2, 0))
-        batch_encoder_outputs = encoder_outputs.swapaxes(0, 1)
-        decoder_context = nd.batch_dot(batch_attention, batch_encoder_outputs)
-        input_and_context = nd.concat(
-            nd.expand_dims(self.embedding(cur_input), axis=1),
-            decoder_context, dim=2)
-        concat_input = self.rnn_concat_input(input_and_context).reshape(
-            (1, -1, 0))
-        concat_input = self.dropout(concat_input)
-        state = [nd.broadcast_axis(single_layer_state[0], axis=0,
-                                   size=self.num_layers)]
-        output, state = self.rnn(concat_input, state)
-        output = self.dropout(output)
-        output = self.out(output).reshape((-3, -1))
-        return output, state
-
-    def begin_state(self, *args, **kwargs):
-        return self.rnn.begin_state(*args, **kwargs)
-
-class DecoderInitState(nn.Block):
-
-    def __init__(self, encoder_num_hiddens, decoder_num_hiddens, **kwargs):
-        super(DecoderInitState, self).__init__(**kwargs)
-        with self.name_scope():
-            self.dense = nn.Dense(decoder_num_hiddens,
-                                  in_units=encoder_num_hiddens,
-                                  activation="tanh", flatten=False)
-
-    def forward(self, encoder_state):
-        return [self.dense(encoder_state)]
+# every batch is split over ctxs, ctx also runs translate
+ctxs = select_contexts(args.device, args.cpu_threads)
+ctx = ctxs[0]
+# before the blocks are built, amp wraps the operators they call
+precision = init_amp(ctx) if use_amp == 1 else 'float32'
+kv = mx.kv.create(kvstore)
+# workers split the same batches, they need the same shuffle and teacher
+# forcing draws. training draws only from these generators so that nothing
+# rank 0 alone does (translate) can put the workers out of step
+seed = 0 if kv.num_workers > 1 else None
+shuffle_rng = np.random.RandomState(seed)
+forcing_rng = random.Random(seed)
 
 def translate(encoder, decoder, decoder_init_state, fr_ens, ctx, max_seq_len):
-    for fr_en in fr_ens:
+    # answer all questions in one batch
+    replies = batch_translate(encoder, decoder, decoder_init_state,
+                              [fr_en[0] for fr_en in fr_ens], input_vocab,
+                              output_vocab, ctx, max_seq_len,
+                              max_test_output_len, beam_size=beam_size)
+    for fr_en, output_tokens in zip(fr_ens, replies):
         print('[input] ', fr_en[0])
-        input_tokens = fr_en[0].split(' ') + [EOS]
-        # use padding =max_seq_len
-
-        while len(input_tokens) < max_seq_len:
-            input_tokens.append(PAD)
-        inputs = nd.array(input_vocab.to_indices(input_tokens), ctx=ctx)
-        encoder_state = encoder.begin_state(func=nd.zeros, batch_size=1,
-                                            ctx=ctx)
-        encoder_outputs, encoder_state = encoder(inputs.expand_dims(0),
-                                                 encoder_state)
-        encoder_outputs = encoder_outputs.flatten()
-        # use bos as first input on decoder
-
-        decoder_input = nd.array([output_vocab.token_to_idx[BOS]], ctx=ctx)
-        decoder_state = decoder_init_state(encoder_state[0])
-        output_tokens = []
-
-        for _ in range(max_test_output_len):
-            decoder_output, decoder_state = decoder(
-                decoder_input, decoder_state, encoder_outputs)
-            pred_i = int(decoder_output.argmax(axis=1).asnumpy()[0])
-            # when out is eos , finish seq
-
-            if pred_i == output_vocab.token_to_idx[EOS]:
-                break
-            else:
-                output_tokens.append(output_vocab.idx_to_token[pred_i])
-            decoder_input = nd.array([pred_i], ctx=ctx)
         print('[output]', ' '.join(output_tokens))
         print('[expect]', fr_en[1], '\n')
 
-def train(encoder, decoder, decoder_init_state, max_seq_len, ctx,retrain,test):
-
-    encoder.initialize(init.Xavier(), ctx=ctx)
-    decoder.initialize(init.Xavier(), ctx=ctx)
-    decoder_init_state.initialize(init.Xavier(), ctx=ctx)
+def train(encoder, decoder, decoder_init_state, max_seq_len, ctxs,retrain,test):
+    ctx = ctxs[0]
+
+    sampler = None
+    if sampled_softmax > 0:
+        # negatives follow the answer token frequencies
+        sampler = UnigramSampler(token_counts(output_indices, output_vocab),
+                                 sampled_softmax,
+                                 rng=np.random.RandomState(seed))
+    model = Seq2Seq(encoder, decoder, decoder_init_state,
+                    output_vocab.token_to_idx[BOS], eos_id, sampler)
+    model.initialize(init.Xavier(), ctx=ctxs)
+    if hybridize == 1:
+        # buckets change the batch shapes from batch to batch
+        hybridize_models(encoder, decoder, decoder_init_state,
+                         static_shape=buckets == 0)
+    # one optimizer over the params of all three blocks
+    trainer = make_trainer(model, lr, optimizer, clip, kv)
+    init_amp_trainer(trainer, precision)
+    checkpoints = CheckpointManager('seq2seq', keep_checkpoints,
+                                    resume=retrain == 1)
+    done_epochs = 0
     if retrain == 1:
-        encoder.load_params('encoder.params')
-        decoder.load_params('decoder.params')
-        decoder_init_state.load_params('decoder_init.params')
+        # the latest checkpoint resumes with its optimizer states and epoch
+        done_epochs = checkpoints.restore(model, trainer, ctxs)
+        if done_epochs is None:
+            done_epochs = 0
+            if os.path.exists('seq2seq.params'):
+                model.load_parameters('seq2seq.params', ctx=ctxs)
+            else:
+                # weights saved as one file per block
+                encoder.load_params('encoder.params')
+                decoder.load_params('decoder.params')
+                decoder_init_state.load_params('decoder_init.params')
         print('load params!!!!!!')
-    encoder_optimizer = gluon.Trainer(encoder.collect_params(), 'adam',
-                                      {'learning_rate': lr})
-    decoder_optimizer = gluon.Trainer(decoder.collect_params(), 'adam',
-                                      {'learning_rate': lr})
-    decoder_init_state_optimizer = gluon.Trainer(
-        decoder_init_state.collect_params(), 'adam', {'learning_rate': lr})
 
-    data_iter = gdata.DataLoader(dataset, batch_size, shuffle=True)
-    l_sum = 0
-    for epoch in range(1, epochs + 1):
+    if buckets > 0:
+        data_iter = bucket_loader(dataset, input_vocab, output_vocab,
+                                  batch_size, buckets, rng=shuffle_rng)
+    else:
+        data_iter = gdata.DataLoader(
+            dataset, batch_size, sampler=RandomSampler(len(dataset),
+                                                       shuffle_rng))
+    # loss and token counters stay on ctx, they are only read back when
+    # reporting so that the engine can run ahead of python
+    l_sum = nd.zeros((1,), ctx=ctx)
+    num_samples, num_tokens = 0, nd.zeros((1,), ctx=ctx)
+    report_tic = time.time()
+    # each device of each worker takes a slice of every batch
+    num_shards = len(ctxs) * kv.num_workers
+    for epoch in range(done_epochs + 1, epochs + 1):
+        epoch_l_sum = nd.zeros((1,), ctx=ctx)
+        ratio = teacher_forcing_ratio(epoch, epochs, teacher_forcing)
         for x, y in data_iter:
-            cur_batch_size = x.shape[0]
+            if x.shape[0] < num_shards:
+                # too few rows to give one to every device
+                continue
+            xs = split_batch(x, ctxs, kv.num_workers, kv.rank)
+            ys = split_batch(y, ctxs, kv.num_workers, kv.rank)
+            forced = forcing_rng.random() < ratio
             with autograd.record():
-                l = nd.array([0], ctx=ctx)
-                valid_length = nd.array([0], ctx=ctx)
-                encoder_state = encoder.begin_state(
-                    func=nd.zeros, batch_size=cur_batch_size, ctx=ctx)
-                encoder_outputs, encoder_state = encoder(x, encoder_state)
-                encoder_outputs = encoder_outputs.flatten()
-                # use bos as init on decoder
-
-                decoder_input = nd.array(
-                    [output_vocab.token_to_idx[BOS]] * cur_batch_size,
-                    ctx=ctx)
-                mask = nd.ones(shape=(cur_batch_size,), ctx=ctx)
-                decoder_state = decoder_init_state(encoder_state[0])
-                for i in range(max_seq_len):
-                    decoder_output, decoder_state = decoder(
-                        decoder_input, decoder_state, encoder_outputs)
-                    # use decoder current  predict  for next  state input
-
-                    decoder_input = decoder_output.argmax(axis=1)
-                    valid_length = valid_length + mask.sum()
-                    l = l + (mask * loss(decoder_output, y[:, i])).sum()
-                    mask = mask * (y[:, i] != eos_id)
-                l = l / valid_length
-            l.backward()
-            encoder_optimizer.step(1)
-            decoder_optimizer.step(1)
-            decoder_init_state_optimizer.step(1)
-            l_sum += l.asscalar() / max_seq_len
+                shards = [model(x_shard, y_shard, loss, forced)
+                          for x_shard, y_shard in zip(xs, ys)]
+                with scale_loss([l for l, _ in shards], trainer) as ls:
+                    autograd.backward(ls)
+            step(trainer, model, clip, num_shards)
+            for l, valid_length in shards:
+                l = l.detach().as_in_context(ctx)
+                l_sum = l_sum + l / max_seq_len / len(shards)
+                epoch_l_sum = epoch_l_sum + l / len(shards)
+                num_tokens = num_tokens + valid_length.as_in_context(ctx)
+            num_samples += sum(x_shard.shape[0] for x_shard in xs)
 
         if epoch % epoch_period == 0 or epoch == 1:
+            elapsed = time.time() - report_tic
             if epoch == 1:
-                print('epoch %d, loss %f, ' % (epoch, l_sum / len(data_iter)))
+                print('epoch %d, loss %f, '
+                      % (epoch, l_sum.asscalar() / len(data_iter)))
             else:
                 print('epoch %d, loss %f, '
-                      % (epoch, l_sum / epoch_period / len(data_iter)))
+                      % (epoch, l_sum.asscalar() / epoch_period / len(data_iter)))
+            print('%.1f samples/sec, %.1f tokens/sec'
+                  % (num_samples / elapsed, num_tokens.asscalar() / elapsed))
             if epoch != 1:
-                l_sum = 0
-
-            translate(encoder, decoder, decoder_init_state, test, ctx, max_seq_len)
-        encoder.save_params('encoder.params')
-        decoder.save_params('decoder.params')
-        decoder_init_state.save_params('decoder_init.params')
-
-input_vocab, output_vocab, input_seqs, output_seqs = read_data(dataset,max_seq_len)
-Q = nd.zeros((len(input_seqs), max_seq_len), ctx=ctx)
-A = nd.zeros((len(output_seqs), max_seq_len), ctx=ctx)
-for i in range(len(input_seqs)):
-    Q[i] = nd.array(input_vocab.to_indices(input_seqs[i]), ctx=ctx)
-    A[i] = nd.array(output_vocab.to_indices(output_seqs[i]), ctx=ctx)
-
-
-
-dataset = gdata.ArrayDataset(Q, A)
+                l_sum = nd.zeros((1,), ctx=ctx)
+
+            if kv.rank == 0:
+                translate(encoder, decoder, decoder_init_state, test, ctx, max_seq_len)
+            num_samples, num_tokens = 0, nd.zeros((1,), ctx=ctx)
+            report_tic = time.time()
+
+        if kv.rank == 0:
+            # written in the background, ranked by the mean loss of the epoch
+            checkpoints.save(epoch, model, trainer,
+                             epoch_l_sum / len(data_iter))
+    checkpoints.wait()
+
+input_vocab, output_vocab, input_indices, output_indices, QA_pair = \
+    load_corpus(dataset, max_seq_len, max_lines=20, keep_pairs=True,
+                cache_dir=cache_dir, mmap_mode='r' if mmap == 1 else None,
+                min_freq=min_freq, max_vocab=max_vocab,
+                joint_vocab=tie_embeddings == 1)
+if mmap == 1 or buckets > 0:
+    dataset = IndexDataset(input_indices, output_indices)
+else:
+    dataset = tensorize(input_indices, output_indices, ctx)
+print('vocab sizes %d, %d, token coverage %.2f%%, %.2f%%' % (
+    len(input_vocab), len(output_vocab),
+    100 * coverage(token_counts(input_indices, input_vocab), input_vocab),
+    100 * coverage(token_counts(output_indices, output_vocab), output_vocab)))
 loss = gloss.SoftmaxCrossEntropyLoss()
 eos_id = output_vocab.token_to_idx[EOS]
 
 encoder = Encoder(len(input_vocab), encoder_num_hiddens, encoder_num_layers,
                   encoder_drop_prob)
+# one embedding for the encoder, the decoder and the output layer
+shared_embedding = encoder.embedding.params if tie_embeddings == 1 else None
 decoder = Decoder(decoder_num_hiddens, len(output_vocab),
                   decoder_num_layers, max_seq_len, decoder_drop_prob,
-                  alignment_size, encoder_num_hiddens)
+                  alignment_size, encoder_num_hiddens, shared_embedding,
+                  tie_embeddings == 1)
 decoder_init_state = DecoderInitState(encoder_num_hiddens,
                                       decoder_num_hiddens)
-
-QA_pair =[]
-with open(args.dataset,'r') as f:
-    pair = f.readlines()
-
-for i in pair:
-    q,a = i.split('@')
-    QA_pair.append([q,a[:-1]])
+if kv.rank == 0:
+    # what serving.py needs besides the params, next to the checkpoints
+    save_model_info('seq2seq', input_vocab, output_vocab, dict(
+        encoder_num_hiddens=encoder_num_hiddens,
+        encoder_num_layers=encoder_num_layers,
+        decoder_num_hiddens=decoder_num_hiddens,
+        decoder_num_layers=decoder_num_layers, alignment_size=alignment_size,
+        max_seq_len=max_seq_len, max_test_output_len=max_test_output_len,
+        tie_embeddings=tie_embeddings == 1))
 
 
 # eval_fr_ens =[['Can we make this quick?  Roxanne Korrine and Andrew Barrett are having an incredibly horrendous public break- up on the quad.  Again.',
 #                'Well, I thought we d start with pronunciation, if thats okay with you.'],
 #               ['Not the hacking and gagging and spitting part', 'Okay... then how bout we try out some French cuisine.  Saturday?  Night?']]
-train(encoder, decoder, decoder_init_state, max_seq_len, ctx,retrain,QA_pair[:5])
+train(encoder, decoder, decoder_init_state, max_seq_len, ctxs,retrain,QA_pair[:5])
 
 # translate(encoder, decoder, decoder_init_state, QA_pair, ctx,max_seq_len)
\ No newline at end of file
@@ -1,9 +1,10 @@
-import collections
-import io
-import mxnet as mx
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 from mxnet import autograd, gluon, init, nd
-from mxnet.contrib import text
 from mxnet.gluon import data as gdata, loss as gloss, nn, rnn
+from corpus import load_corpus, tensorize
+from device import select_contexts
 
 PAD = '<pad>'
 BOS = '<bos>'
@@ -24,49 +25,18 @@ decoder_drop_prob = 0.1
 encoder_num_hiddens = 256
 decoder_num_hiddens = 256
 alignment_size = 25
-ctx = mx.cpu(0)
-
-def read_data(max_seq_len):
-    input_tokens = []
-    output_tokens = []
-    input_seqs = []
-    output_seqs = []
-    with io.open('QAtraining.txt') as f:
-        lines = f.readlines()
-        for line in lines[:20]:
-            input_seq, output_seq = line.rstrip().split('@')
-            print(input_seq,output_seq)
-            cur_input_tokens = input_seq.split(' ')
-            cur_output_tokens = output_seq.split(' ')
-            if len(cur_input_tokens) < max_seq_len and \
-                    len(cur_output_tokens) < max_seq_len:
-                input_tokens.extend(cur_input_tokens)
-                # 句末附上 EOS 符号。
-                cur_input_tokens.append(EOS)
-                # 添加 PAD 符号使每个序列等长（长度为 max_seq_len ）。
-                while len(cur_input_tokens) < max_seq_len:
-                    cur_input_tokens.append(PAD)
-                input_seqs.append(cur_input_tokens)
-                output_tokens.extend(cur_output_tokens)
-                cur_output_tokens.append(EOS)
-                while len(cur_output_tokens) < max_seq_len:
-                    cur_output_tokens.append(PAD)
-                output_seqs.append(cur_output_tokens)
-        fr_vocab = text.vocab.Vocabulary(collections.Counter(input_tokens),
-                                         reserved_tokens=[PAD, BOS, EOS])
-        en_vocab = text.vocab.Vocabulary(collections.Counter(output_tokens),
-                                         reserved_tokens=[PAD, BOS, EOS])
-    return fr_vocab, en_vocab, input_seqs, output_seqs
-
-input_vocab, output_vocab, input_seqs, output_seqs = read_data(max_seq_len)
-fr = nd.zeros((len(input_seqs), max_seq_len), ctx=ctx)
-en = nd.zeros((len(output_seqs), max_seq_len), ctx=ctx)
-for i in range(len(input_seqs)):
-    fr[i] = nd.array(input_vocab.to_indices(input_seqs[i]), ctx=ctx)
-    en[i] = nd.array(output_vocab.to_indices(output_seqs[i]), ctx=ctx)
-print(len(fr))
-print(len(en))
-dataset = gdata.ArrayDataset(fr, en)
+# rarer tokens map to <unk>, None keeps every token
+min_freq = 1
+max_vocab = None
+# $CHATBOT_DEVICE, or the gpu when there is one
+ctx = select_contexts()[0]
+
+input_vocab, output_vocab, input_indices, output_indices, _ = load_corpus(
+    'QAtraining.txt', max_seq_len, max_lines=20, min_freq=min_freq,
+    max_vocab=max_vocab)
+print(len(input_indices))
+print(len(output_indices))
+dataset = tensorize(input_indices, output_indices, ctx)
 
 class Encoder(nn.Block):
     """ encoder"""
@@ -0,0 +1,50 @@
+""" serve a trained model over local http, see serving.py
+
+python serve.py --prefix seq2seq --port 8000
+python serve.py --prefix seq2seq --unix_socket /tmp/chatbot.sock
+
+curl -d '{"question": "how are you ?"}' localhost:8000/reply
+curl -X POST localhost:8000/reload
+"""
+import argparse
+
+from device import add_device_arguments, select_contexts
+from serving import ChatBot, MicroBatcher, make_server
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--prefix", help="prefix of the model files, the --wname of training", type=str, default='seq2seq')
+parser.add_argument("--epoch", help="checkpoint to load, defaults to the best one", type=int, default=None)
+parser.add_argument("--host", help="address to listen on", type=str, default='127.0.0.1')
+parser.add_argument("--port", help="port to listen on", type=int, default=8000)
+parser.add_argument("--unix_socket", help="listen on this unix socket instead of host:port", type=str, default=None)
+parser.add_argument("--max_batch_size", help="most questions answered in one forward pass", type=int, default=32)
+parser.add_argument("--max_wait_ms", help="longest a question waits for others to batch with", type=float, default=5)
+parser.add_argument("--beam_size", help="beam width, 1 decodes greedily", type=int, default=1)
+parser.add_argument("--cache_size", help="replies kept in the response cache, 0 disables it", type=int, default=10000)
+parser.add_argument("--cache_ttl", help="seconds a cached reply is used, 0 keeps it until evicted or reloaded", type=float, default=0)
+parser.add_argument("--shortlist", help="replies only use this many most frequent output tokens, 0 uses the whole vocabulary", type=int, default=0)
+parser.add_argument("--verbose", help="log every request", type=int, default=0)
+add_device_arguments(parser)
+args = parser.parse_args()
+
+ctx = select_contexts(args.device, args.cpu_threads)[0]
+bot = ChatBot(args.prefix, ctx, args.epoch, args.beam_size,
+              cache_size=args.cache_size, cache_ttl=args.cache_ttl or None,
+              shortlist=args.shortlist)
+print('loaded %s on %s' % (bot.params_file, ctx))
+# the first forward pass builds the graphs, before any request waits on it
+bot.replies(['hello'])
+batcher = MicroBatcher(bot.replies, args.max_batch_size,
+                       args.max_wait_ms / 1000., bot.cached_reply,
+                       bot.tokenize)
+server = make_server(batcher, args.host, args.port, args.unix_socket,
+                     args.verbose == 1, bot)
+print('listening on %s' % (args.unix_socket or '%s:%d' % (args.host,
+                                                          args.port)))
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+    batcher.close()
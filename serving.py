@@ -0,0 +1,545 @@
+""" answer questions with a trained model, loaded once, over local http
+
+the vocabularies and the sizes of the blocks come from <prefix>-model.pkl,
+which the training scripts write, the params from the best checkpoint of
+<prefix>-checkpoints.json, else <prefix>.params, else the per block files
+<prefix>_encoder.params, <prefix>_decoder.params and
+<prefix>_decoderinit.params. serve.py runs the server, loadgen.py measures
+it. AsyncChatBot answers from an asyncio event loop.
+
+replies can be cached, keyed on the question as the encoder sees it (its
+index row, so questions differing only past max_seq_len or in unknown
+tokens share a reply), the decoding settings and the params file.
+"""
+import asyncio
+import http.client
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from mxnet import nd
+
+from cache import LRUCache
+from checkpoint import load_model_info, read_index
+from corpus import BOS, EOS
+from device import select_contexts
+from inference import (batch_translate, beam_search_decode, encode,
+                       greedy_decode, indices2tokens, questions2indices,
+                       shortlist_decoder)
+from model import (Decoder, DecoderInitState, Encoder, Seq2Seq,
+                   hybridize_models)
+
+
+def build_models(config, input_vocab, output_vocab):
+    """ encoder, decoder and decoder init state of a saved config
+
+    dropout is left out, it does nothing at inference.
+    """
+    encoder = Encoder(len(input_vocab), config['encoder_num_hiddens'],
+                      config['encoder_num_layers'], 0.)
+    tie_embeddings = config.get('tie_embeddings', False)
+    decoder = Decoder(config['decoder_num_hiddens'], len(output_vocab),
+                      config['decoder_num_layers'], config['max_seq_len'], 0.,
+                      config['alignment_size'], config['encoder_num_hiddens'],
+                      encoder.embedding.params if tie_embeddings else None,
+                      tie_embeddings)
+    decoder_init_state = DecoderInitState(config['encoder_num_hiddens'],
+                                          config['decoder_num_hiddens'])
+    return encoder, decoder, decoder_init_state
+
+
+def load_params(prefix, model, ctx, epoch=None):
+    """ load the params of a prefix into a Seq2Seq, returns the file used"""
+    index = read_index(prefix)
+    if epoch is None:
+        epoch = index['best']
+    if epoch is not None:
+        filename = '%s-%04d.params' % (prefix, epoch)
+        model.load_parameters(filename, ctx=ctx)
+        return filename
+    if os.path.exists(prefix + '.params'):
+        model.load_parameters(prefix + '.params', ctx=ctx)
+        return prefix + '.params'
+    # weights saved as one file per block
+    model.encoder.load_params(prefix + '_encoder.params', ctx=ctx)
+    model.decoder.load_params(prefix + '_decoder.params', ctx=ctx)
+    model.decoder_init_state.load_params(prefix + '_decoderinit.params',
+                                         ctx=ctx)
+    return prefix + '_encoder.params'
+
+
+class ChatBot(object):
+    """ a trained model and its vocabularies, loaded once
+
+    replies() and reload() take turns on a lock, a server calls replies()
+    from one thread (see MicroBatcher). with cache_size > 0 the replies
+    are kept in an LRU cache, for cache_ttl seconds if given, which
+    cached_reply() looks up from any thread.
+
+    for several candidates of one question, encode() returns a handle of
+    the encoded question which decode() takes any number of times, the
+    last context_cache_size handles are kept in an LRU cache.
+
+    with shortlist > 0 the replies only use the shortlist most frequent
+    output tokens, see inference.shortlist_decoder.
+    """
+    def __init__(self, prefix, ctx=None, epoch=None, beam_size=1,
+                 length_penalty=0.6, hybridize=True, cache_size=0,
+                 cache_ttl=None, context_cache_size=256, shortlist=0):
+        self.prefix = prefix
+        self.ctx = select_contexts()[0] if ctx is None else ctx
+        self.input_vocab, self.output_vocab, self.config = \
+            load_model_info(prefix)
+        self.encoder, self.decoder, self.decoder_init_state = build_models(
+            self.config, self.input_vocab, self.output_vocab)
+        self.model = Seq2Seq(self.encoder, self.decoder,
+                             self.decoder_init_state,
+                             self.output_vocab.token_to_idx[BOS],
+                             self.output_vocab.token_to_idx[EOS])
+        self.shortlist = shortlist if 0 < shortlist < len(self.output_vocab) \
+            else 0
+        if 0 < self.shortlist <= self.output_vocab.token_to_idx[EOS]:
+            raise ValueError('a shortlist of %d tokens leaves out %s'
+                             % (shortlist, EOS))
+        # the full output layer, the params are loaded into it
+        self._out = self.decoder.out
+        self._load_params(epoch)
+        if hybridize:
+            # the batch size changes with every micro-batch
+            hybridize_models(self.encoder, self.decoder,
+                             self.decoder_init_state, static_shape=False)
+        self.beam_size = beam_size
+        self.length_penalty = length_penalty
+        self.cache = LRUCache(cache_size, cache_ttl) if cache_size > 0 \
+            else None
+        self.contexts = LRUCache(context_cache_size) \
+            if context_cache_size > 0 else None
+        self._lock = threading.Lock()
+
+    def reload(self, epoch=None):
+        """ load new params, the best checkpoint by default, and drop the
+        cached replies and handles of the old ones
+        """
+        with self._lock:
+            self._load_params(epoch)
+            for cache in (self.cache, self.contexts):
+                if cache is not None:
+                    cache.clear()
+        return self.params_file
+
+    def _load_params(self, epoch):
+        self.decoder.out = self._out
+        self.params_file = load_params(self.prefix, self.model, self.ctx,
+                                       epoch)
+        if self.shortlist:
+            shortlist_decoder(self.decoder, self.shortlist)
+
+    def tokenize(self, question):
+        """ question with its tokens joined by single spaces, TypeError or
+        ValueError when it is not a string or has no tokens
+        """
+        if not isinstance(question, str):
+            raise TypeError('a question is a string, not %s'
+                            % type(question).__name__)
+        tokens = question.split()
+        if not tokens:
+            raise ValueError('empty question')
+        return ' '.join(tokens)
+
+    def indices(self, questions):
+        return questions2indices(questions, self.input_vocab,
+                                 self.config['max_seq_len'])
+
+    def cache_keys(self, questions):
+        settings = (self.beam_size, self.length_penalty,
+                    self.config['max_test_output_len'], self.params_file)
+        return [(row.tobytes(),) + settings
+                for row in self.indices(questions)]
+
+    def encode(self, question):
+        """ handle of the encoded question, reused while it is cached"""
+        indices = self.indices([question])
+        key = (indices[0].tobytes(), self.params_file)
+        with self._lock:
+            context = None if self.contexts is None else \
+                self.contexts.get(key)
+            if context is None:
+                context = encode(self.encoder, self.decoder,
+                                 self.decoder_init_state,
+                                 nd.array(indices, ctx=self.ctx), self.ctx)
+                if self.contexts is not None:
+                    self.contexts.put(key, context)
+        return context
+
+    def decode(self, context, beam_size=None, length_penalty=None,
+               temperature=None):
+        """ a reply from a handle of encode(), without running the encoder
+
+        beam_size and length_penalty default to the settings of the bot, a
+        temperature samples the reply instead.
+        """
+        beam_size = self.beam_size if beam_size is None else beam_size
+        length_penalty = self.length_penalty if length_penalty is None \
+            else length_penalty
+        bos_id = self.output_vocab.token_to_idx[BOS]
+        eos_id = self.output_vocab.token_to_idx[EOS]
+        max_test_output_len = self.config['max_test_output_len']
+        with self._lock:
+            if beam_size > 1 and not temperature:
+                preds = beam_search_decode(
+                    self.encoder, self.decoder, self.decoder_init_state, None,
+                    bos_id, eos_id, self.ctx, max_test_output_len, beam_size,
+                    length_penalty, context)
+            else:
+                preds = greedy_decode(
+                    self.encoder, self.decoder, self.decoder_init_state, None,
+                    bos_id, eos_id, self.ctx, max_test_output_len, context,
+                    temperature).asnumpy().astype(np.int32)
+        return ' '.join(indices2tokens(preds, self.output_vocab)[0])
+
+    def cached_reply(self, question):
+        """ the cached reply to question, None when it has to be decoded"""
+        if self.cache is None:
+            return None
+        return self.cache.get(self.cache_keys([question])[0])
+
+    def replies(self, questions):
+        """ one reply string per question, all in one batch
+
+        repeated questions are decoded once. the cache is only written
+        here, cached_reply() is the lookup.
+        """
+        with self._lock:
+            if self.cache is None:
+                return self._decode(questions)
+            keys = self.cache_keys(questions)
+            unique = dict(zip(keys, questions))
+            decoded = dict(zip(unique, self._decode(list(unique.values()))))
+            for key, reply in decoded.items():
+                self.cache.put(key, reply)
+            return [decoded[key] for key in keys]
+
+    def _decode(self, questions):
+        replies = batch_translate(
+            self.encoder, self.decoder, self.decoder_init_state, questions,
+            self.input_vocab, self.output_vocab, self.ctx,
+            self.config['max_seq_len'], self.config['max_test_output_len'],
+            len(questions), self.beam_size, self.length_penalty)
+        return [' '.join(tokens) for tokens in replies]
+
+
+class MicroBatcher(object):
+    """ coalesce concurrent questions into batches for one model thread
+
+    a batch closes when it holds max_batch_size questions or max_wait
+    seconds after its first question arrived, whichever comes first.
+    answer maps a list of questions to the list of their replies, lookup
+    (ChatBot.cached_reply) answers a question without queueing it when it
+    returns a reply. prepare (ChatBot.tokenize) runs on every question
+    before, on the submitting thread, so that a bad question fails its own
+    future only. a batch which fails as a whole is answered question by
+    question.
+    """
+    def __init__(self, answer, max_batch_size=32, max_wait=0.005,
+                 lookup=None, prepare=None):
+        self.answer = answer
+        self.lookup = lookup
+        self.prepare = prepare
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.num_requests = 0
+        self.num_batches = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, question, lookup=True):
+        """ a Future of the reply, lookup=False skips the cache for callers
+        which already looked
+        """
+        future = Future()
+        if self.prepare is not None:
+            try:
+                question = self.prepare(question)
+            except Exception as e:
+                future.set_exception(e)
+                return future
+        reply = None if self.lookup is None or not lookup else \
+            self.lookup(question)
+        if reply is not None:
+            future.set_result(reply)
+        else:
+            self._queue.put((question, future))
+        return future
+
+    def reply(self, question, timeout=None):
+        return self.submit(question).result(timeout)
+
+    def stats(self):
+        return {'requests': self.num_requests, 'batches': self.num_batches,
+                'mean_batch_size': self.num_requests /
+                float(max(self.num_batches, 1))}
+
+    def close(self):
+        """ answer the questions already queued, then stop the thread"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    # past the deadline, only what is already queued
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # answer this batch first, stop on the next call
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            # cancelled requests are dropped before the forward pass
+            batch = [(question, future) for question, future in batch
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            self.num_requests += len(batch)
+            self.num_batches += 1
+            try:
+                replies = self.answer([question for question, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+                # one bad question must not fail the others of its batch
+                for question, future in batch:
+                    try:
+                        future.set_result(self.answer([question])[0])
+                    except Exception as e:
+                        future.set_exception(e)
+            else:
+                for (_, future), reply in zip(batch, replies):
+                    future.set_result(reply)
+
+
+class AsyncChatBot(object):
+    """ asyncio front of a ChatBot, `await bot.reply(text)`
+
+    replies are decoded on the thread of a MicroBatcher, the event loop
+    only waits on futures and looks up the reply cache. ChatBot.reload(),
+    encode() and decode() call into mxnet from their callers' threads,
+    every model call of the ChatBot takes its lock, so they wait for the
+    batch in flight and the other way round. at most max_pending
+    questions are queued or running, reply() waits for a free slot before
+    queueing (backpressure). a cancelled or timed out reply is dropped
+    unless its batch already runs.
+    """
+    def __init__(self, bot, max_batch_size=32, max_wait=0.005,
+                 max_pending=256):
+        self.bot = bot
+        self.batcher = MicroBatcher(bot.replies, max_batch_size, max_wait,
+                                    bot.cached_reply, bot.tokenize)
+        self.max_pending = max_pending
+        self.num_pending = 0
+        self._slots = None
+
+    @classmethod
+    async def load(cls, prefix, ctx=None, epoch=None, beam_size=1,
+                   max_batch_size=32, max_wait=0.005, max_pending=256):
+        """ load the model off the event loop"""
+        bot = await asyncio.get_running_loop().run_in_executor(
+            None, ChatBot, prefix, ctx, epoch, beam_size)
+        return cls(bot, max_batch_size, max_wait, max_pending)
+
+    async def reply(self, text, timeout=None):
+        """ the reply to text, asyncio.TimeoutError after timeout seconds,
+        the wait for a slot included
+        """
+        return await asyncio.wait_for(self._reply(text), timeout)
+
+    async def _reply(self, text):
+        text = self.bot.tokenize(text)
+        # cached replies skip the queue and take no slot
+        reply = self.bot.cached_reply(text)
+        if reply is not None:
+            return reply
+        loop = asyncio.get_running_loop()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        await self._slots.acquire()
+        self.num_pending += 1
+        future = self.batcher.submit(text, lookup=False)
+        # the slot is freed when the model is done with the question, not
+        # when the caller stops waiting for it
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._release))
+        # cancelling the wrapper cancels the queued question
+        return await asyncio.wrap_future(future)
+
+    def _release(self):
+        self.num_pending -= 1
+        self._slots.release()
+
+    async def close(self):
+        """ answer what is queued and stop the model thread"""
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.batcher.close)
+
+
+class ReplyHandler(BaseHTTPRequestHandler):
+    """ POST /reply {"question": ...} answers {"reply": ...},
+    GET /stats returns the batching and cache counters, POST /reload loads
+    the best checkpoint (or {"epoch": ...}) and empties the cache
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # headers and body are two writes, with nagle on tcp the body waits
+        # for the delayed ack of the headers (40 ms)
+        self.disable_nagle_algorithm = \
+            self.server.address_family != socket.AF_UNIX
+        BaseHTTPRequestHandler.setup(self)
+
+    def do_POST(self):
+        if self.path == '/reload':
+            self.reload()
+            return
+        if self.path != '/reply':
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            question = json.loads(self.rfile.read(length).decode())['question']
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400, 'expected {"question": ...}')
+            return
+        if not isinstance(question, str) or not question.strip():
+            self.send_error(400, 'the question has to be a non empty string')
+            return
+        try:
+            reply = self.server.batcher.reply(question)
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        self.send_json({'reply': reply})
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        stats = self.server.batcher.stats()
+        bot = self.server.bot
+        if bot is not None and bot.cache is not None:
+            stats['cache'] = bot.cache.stats()
+        self.send_json(stats)
+
+    def reload(self):
+        if self.server.bot is None:
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            epoch = json.loads(self.rfile.read(length).decode() or '{}') \
+                .get('epoch')
+            params_file = self.server.bot.reload(epoch)
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        self.send_json({'params': params_file})
+
+    def send_json(self, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket peers have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+
+
+def make_server(batcher, host='127.0.0.1', port=8000, unix_socket=None,
+                verbose=False, bot=None):
+    """ http server answering through batcher, on a unix socket if given
+
+    with the ChatBot of the batcher as bot, /stats includes its cache and
+    /reload works.
+    """
+    if unix_socket is not None:
+        server = UnixHTTPServer(unix_socket, ReplyHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ReplyHandler)
+    server.batcher = batcher
+    server.bot = bot
+    server.verbose = verbose
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ http client connection over a unix socket"""
+    def __init__(self, path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost',
+                                            timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def connect(host='127.0.0.1', port=8000, unix_socket=None, timeout=None):
+    if unix_socket is not None:
+        return UnixHTTPConnection(unix_socket, timeout)
+    return http.client.HTTPConnection(host, port, timeout=timeout)
+
+
+def request_reply(connection, question):
+    """ ask a running server over a kept-alive connection"""
+    connection.request('POST', '/reply', json.dumps({'question': question}),
+                       {'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    body = response.read()
+    if response.status != 200:
+        raise RuntimeError('server answered %d %s' % (response.status,
+                                                      response.reason))
+    return json.loads(body.decode())['reply']
@@ -0,0 +1,58 @@
+from mxnet import gluon
+from mxnet.contrib import amp
+
+
+def make_trainer(model, lr, optimizer='adam', clip_norm=None,
+                 kvstore='device'):
+    """ one Trainer over the params of every sub-block of model
+
+    optimizers with multi-tensor kernels (e.g. sgd, lamb) aggregate their
+    updates over MXNET_OPTIMIZER_AGGREGATION_SIZE params per call. the
+    kvstore sums the gradients of all devices (and workers for dist_*).
+    """
+    # the updates run in the trainer, not the kvstore, clipping needs the
+    # gradients before the update and checkpoints need the optimizer states
+    return gluon.Trainer(model.collect_params(), optimizer,
+                         {'learning_rate': lr}, kvstore=kvstore,
+                         update_on_kvstore=False)
+
+
+def split_batch(batch, ctxs, num_workers=1, rank=0):
+    """ the rows of this worker, split over its devices
+
+    every worker iterates the same batches (same shuffle seed) and keeps
+    its own slice, so all workers take the same number of steps.
+    """
+    if num_workers > 1:
+        batch = gluon.utils.split_data(batch, num_workers,
+                                       even_split=False)[rank]
+    return gluon.utils.split_and_load(batch, ctxs, even_split=False)
+
+
+def step(trainer, model, clip_norm=None, num_shards=1):
+    """ one update, with the gradients clipped to clip_norm global norm
+
+    the gradients are summed over num_shards per shard mean losses.
+    """
+    if not clip_norm:
+        trainer.step(num_shards)
+        return
+    trainer.allreduce_grads()
+    if getattr(trainer, '_amp_loss_scaler', None) is not None:
+        # clip the gradients of the loss, not of the scaled loss
+        amp.unscale(trainer)
+    params = [param for param in model.collect_params().values()
+              if param.grad_req != 'null']
+    for ctx in params[0].list_ctx():
+        # check_isfinite would sync with the host on every batch, the sum
+        # is clipped so that the mean over the shards has clip_norm
+        gluon.utils.clip_global_norm([param.grad(ctx) for param in params],
+                                     clip_norm * num_shards,
+                                     check_isfinite=False)
+    trainer.update(num_shards)
+
+
+def teacher_forcing_ratio(epoch, epochs, start):
+    """ scheduled sampling, the share of teacher forced batches decays
+    linearly from start on the first epoch towards 0 on the last one"""
+    return start * (1. - (epoch - 1.) / epochs)
@@ -0,0 +1,33 @@
+""" coverage of the corpus tokens versus the vocabulary size, to pick
+--max_vocab or --min_freq for the training scripts
+
+python vocab_report.py --dataset data.txt --sizes 1000,5000,10000,20000
+"""
+import argparse
+import collections
+
+from corpus import coverage_table, read_pairs
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--dataset", help="corpus file, one question<sep>answer per line", type=str, required=True)
+parser.add_argument("--sep", help="separator of question and answer", type=str, default='@')
+parser.add_argument("--encoding", help="encoding of the corpus file", type=str, default=None)
+parser.add_argument("--max_seq_len", help="longer pairs are skipped, as in training", type=int, default=15)
+parser.add_argument("--sizes", help="comma separated vocabulary sizes to report", type=str, default='1000,2000,5000,10000,20000,50000')
+args = parser.parse_args()
+
+input_counter = collections.Counter()
+output_counter = collections.Counter()
+for input_tokens, output_tokens in read_pairs(args.dataset, args.max_seq_len,
+                                              args.sep, args.encoding):
+    input_counter.update(input_tokens)
+    output_counter.update(output_tokens)
+
+sizes = [int(size) for size in args.sizes.split(',')]
+for name, counter in (('input', input_counter), ('output', output_counter)):
+    print('%s: %d distinct tokens, %d singletons'
+          % (name, len(counter),
+             sum(1 for count in counter.values() if count == 1)))
+    print('     size  min_freq  coverage')
+    for size, min_count, covered in coverage_table(counter, sizes):
+        print('%9d  %8d  %7.2f%%' % (size, min_count, 100. * covered))